@@ -0,0 +1,755 @@
+"""Headless benchmark and load test for deploy.py.
+
+Drives the app through Streamlit's AppTest against synthetic catalogs and
+times the operations a cashier performs: a full script rerun, a search,
+a quantity click (update_quantity + cart total), adding and deleting a
+product, and saving the catalog. Results can be written as JSON and
+compared against an earlier run to catch regressions.
+
+    python benchmark.py --sizes 1000 10000 100000 --output results.json
+    python benchmark.py --sizes 10000 --concurrent 8 --clicks 20
+    python benchmark.py --compare baseline.json --output results.json
+    python benchmark.py --sizes 10000 --sessions 50
+    python benchmark.py --sizes 100000 --schema-report
+    python benchmark.py --orders-report 1000000
+    python benchmark.py --contention 16 --clicks 50
+    python benchmark.py --sizes 10000 --live --clicks 20
+    python benchmark.py --sizes 100000 --startup
+    python benchmark.py --sizes 10000 --workers 4 --concurrent 16 --clicks 20
+"""
+import argparse
+import ast
+import asyncio
+import datetime
+import gc
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import pandas as pd
+from streamlit.logger import set_log_level
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "deploy.py")
+SERVE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "serve.py")
+COUNTRIES = ["China", "Germany", "Malaysia", "Hungary", "Egypt"]
+SEARCH_QUERIES = [("Product 12", "Name/Description"), ("وات", "Name/Description"), ("BM0000", "Part Number"), ("3165140", "Barcode")]
+
+
+# Function to append the EAN-13 check digit to a 12-digit number
+def ean13(base):
+    digits = f"{base:012d}"
+    total = sum(int(digit) * (3 if i % 2 else 1) for i, digit in enumerate(digits))
+    return int(digits + str((10 - total % 10) % 10))
+
+
+# Function to build a synthetic catalog in the same shape as inventory_data.json
+def make_catalog(size, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            "Part Number": f"BM{i:08d}",
+            "Product Name": f"Benchmark Product {i}",
+            "Description": f"ماكينة اختبار رقم {i} - {rng.randint(100, 2500)} وات",
+            "Country": rng.choice(COUNTRIES),
+            "Price (EGP)": round(rng.uniform(50, 60000), 2),
+            "Barcode": ean13(316514000000 + i),
+        }
+        for i in range(size)
+    ]
+
+
+# Function to write a synthetic catalog into a fresh working directory
+def prepare_workdir(size):
+    workdir = tempfile.mkdtemp(prefix=f"dokkan_bench_{size}_")
+    with open(os.path.join(workdir, "inventory_data.json"), "w", encoding="utf-8") as f:
+        json.dump(make_catalog(size), f, ensure_ascii=False)
+    return workdir
+
+
+# Function to load the functions and constants of deploy.py without running its UI code
+def load_app_functions():
+    with open(APP_PATH, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), APP_PATH)
+    # deploy.py is a Streamlit script, so keep only imports, upper-case constants and function definitions
+    body = [
+        node for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef))
+        or (isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) and target.id.isupper() for target in node.targets))
+    ]
+    namespace = {}
+    exec(compile(ast.Module(body, type_ignores=[]), APP_PATH, "exec"), namespace)
+    return namespace
+
+
+# Function to time a callable several times and return the samples in milliseconds
+def time_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+# Function to summarize latency samples
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "mean_ms": statistics.fmean(ordered),
+        "p50_ms": statistics.median(ordered),
+        "p99_ms": ordered[min(len(ordered) - 1, round(0.99 * (len(ordered) - 1)))],
+    }
+
+
+# Function to read the peak resident set size of this process in MB
+def peak_rss_mb():
+    # ru_maxrss is reported in KB on Linux and in bytes on macOS
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+# Function to read the resident set size of this process in MB
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+# Function to submit the Add Product form with a synthetic product
+def submit_product(at, i):
+    at.text_input(key="new_part_number").input(f"NEW{i:06d}")
+    at.text_input(key="new_product_name").input(f"New Product {i}")
+    at.text_area(key="new_description").input("منتج جديد")
+    at.text_input(key="new_country").input("Egypt")
+    at.number_input(key="new_price").set_value(99.5)
+    at.text_input(key="new_barcode").input(str(ean13(622000000000 + i)))
+    next(button for button in at.button if button.label == "Add Product").click().run()
+
+
+# Function to delete a product through the confirmation flow
+def delete_product(at, product_id):
+    at.button(key=f"del_{product_id}").click().run()
+    at.button(key="confirm_delete").click().run()
+
+
+# Function to benchmark every operation against one catalog size
+def bench_size(size, repeat):
+    workdir = prepare_workdir(size)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        at = AppTest.from_file(APP_PATH, default_timeout=600)
+        results = {"size": size, "cold": summarize(time_ms(at.run, 1))}
+        results["rerun"] = summarize(time_ms(at.run, repeat))
+
+        queries = iter(SEARCH_QUERIES * repeat)
+
+        def search():
+            query, search_type = next(queries)
+            at.radio[0].set_value(search_type)
+            at.text_input(key="search_input").input(query).run()
+
+        results["search"] = summarize(time_ms(search, repeat))
+        at.text_input(key="search_input").input("").run()
+
+        inc_key = f"inc_{at.session_state.products_df['ID'].iat[0]}"
+        results["click"] = summarize(time_ms(lambda: at.button(key=inc_key).click().run(), repeat))
+
+        # Only the open tab runs, so switch to the form before filling it in
+        at.session_state["active_tab"] = "Add New Product"
+        at.run()
+        counter = iter(range(repeat))
+        added = []
+
+        def add():
+            i = next(counter)
+            submit_product(at, i)
+            added.append(at.session_state.products_df['ID'].iat[-1])
+
+        results["add_product"] = summarize(time_ms(add, repeat))
+        # Deleting goes through the Manage Inventory list, so open the last page where the added products are
+        at.session_state["active_tab"] = "Manage Inventory"
+        at.session_state["inventory_page_size"] = 100
+        at.session_state["inventory_page"] = (size + repeat - 1) // 100
+        at.run()
+        results["delete_product"] = summarize(time_ms(lambda: delete_product(at, added.pop()), repeat))
+
+        app = load_app_functions()
+        df = at.session_state.products_df
+        results["save_data"] = summarize(time_ms(lambda: app["save_data"](df), repeat))
+
+        results["errors"] = [str(exception.value) for exception in at.exception]
+        results["peak_rss_mb"] = peak_rss_mb()
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+# Function run in a worker process: one session clicking ➕ repeatedly
+def session_worker(workdir, clicks, index, start_barrier, results):
+    set_log_level("error")
+    os.chdir(workdir)
+    at = AppTest.from_file(APP_PATH, default_timeout=600).run()
+    inc_key = f"inc_{at.session_state.products_df['ID'].iat[0]}"
+    start_barrier.wait()
+    samples = time_ms(lambda: at.button(key=inc_key).click().run(), clicks)
+    results.put({"samples": samples, "peak_rss_mb": peak_rss_mb()})
+
+
+# Function run in a worker process: one cart reserving the same product one unit at a time
+def contention_worker(workdir, clicks, product_id, index, start_barrier, results):
+    set_log_level("error")
+    os.chdir(workdir)
+    app = load_app_functions()
+    cart_id = f"bench{index}"
+    reserved = 0
+    samples = []
+    start_barrier.wait()
+    started = time.time()
+    for _ in range(clicks):
+        start = time.perf_counter()
+        granted, _ = app["reserve_stock"](app["DEFAULT_BRANCH"], cart_id, product_id, reserved + 1)
+        samples.append((time.perf_counter() - start) * 1000)
+        if granted:
+            reserved += 1
+    results.put({"samples": samples, "reserved": reserved, "started": started, "finished": time.time()})
+
+
+# Function to run a worker function in several spawned processes released together, returns their reports
+def run_workers(worker_name, count, *args):
+    # AppTest leaves the app installed as __main__, which spawned workers would re-run on startup,
+    # so put the benchmark module back in its place while the workers are launched
+    benchmark_module = importlib.import_module(os.path.splitext(os.path.basename(__file__))[0])
+    context = multiprocessing.get_context("spawn")
+    start_barrier = context.Barrier(count)
+    results = context.Queue()
+    workers = [context.Process(target=getattr(benchmark_module, worker_name), args=(*args, index, start_barrier, results)) for index in range(count)]
+    app_main = sys.modules["__main__"]
+    sys.modules["__main__"] = benchmark_module
+    try:
+        for worker in workers:
+            worker.start()
+    finally:
+        sys.modules["__main__"] = app_main
+    reports = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return reports
+
+
+# Function to load-test N concurrent sessions against one catalog
+def bench_concurrent(size, sessions, clicks):
+    # AppTest is not thread-safe, so each session runs in its own process sharing the same data directory
+    workdir = prepare_workdir(size)
+    reports = run_workers("session_worker", sessions, workdir, clicks)
+
+    samples = [sample for report in reports for sample in report["samples"]]
+    return {
+        "size": size,
+        "sessions": sessions,
+        "click": summarize(samples),
+        "peak_rss_mb_per_session": max(report["peak_rss_mb"] for report in reports),
+        "peak_rss_mb_total": sum(report["peak_rss_mb"] for report in reports),
+    }
+
+
+# Function to have many carts reserve the same product at once and check that stock is never oversold
+def bench_contention(sessions, clicks, stock):
+    workdir = prepare_workdir(10)
+    product = make_catalog(1)[0]
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        app = load_app_functions()
+        app["init_db"]()
+        with sqlite3.connect("inventory.db") as conn:
+            product_id = conn.execute("SELECT id FROM products WHERE part_number = ? AND product_name = ?", (product["Part Number"], product["Product Name"])).fetchone()[0]
+        app["set_stock"](app["DEFAULT_BRANCH"], product_id, stock)
+        reports = run_workers("contention_worker", sessions, workdir, clicks, product_id)
+        with sqlite3.connect("inventory.db") as conn:
+            stored = conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM reservations").fetchone()[0]
+    finally:
+        os.chdir(cwd)
+
+    granted = sum(report["reserved"] for report in reports)
+    elapsed = max(report["finished"] for report in reports) - min(report["started"] for report in reports)
+    return {
+        "sessions": sessions,
+        "attempts": sessions * clicks,
+        "stock": stock,
+        "granted": granted,
+        "stored_reservations": stored,
+        "oversold": max(0, stored - stock),
+        "reserve": summarize([sample for report in reports for sample in report["samples"]]),
+        "attempts_per_second": sessions * clicks / elapsed,
+    }
+
+
+# Function to start `streamlit run` on a free port in a working directory, returns (process, port)
+def start_server(workdir, app_path, env=None):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "streamlit", "run", app_path,
+            "--server.headless", "true", "--server.port", str(port), "--server.address", "127.0.0.1",
+            "--server.enableXsrfProtection", "false", "--browser.gatherUsageStats", "false",
+        ],
+        cwd=workdir,
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 60
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return process, port
+        except OSError:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError("streamlit server did not start")
+            time.sleep(0.2)
+
+
+# Function to run the script (or one fragment) over a live session's websocket, returns (ms, [(element, fragment id)])
+async def live_rerun(websocket, widget_states=(), fragment_id=""):
+    from streamlit.proto.BackMsg_pb2 import BackMsg
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+    message = BackMsg()
+    message.rerun_script.query_string = ""
+    message.rerun_script.page_script_hash = ""
+    message.rerun_script.fragment_id = fragment_id
+    message.rerun_script.widget_states.widgets.extend(widget_states)
+    start = time.perf_counter()
+    await websocket.send(message.SerializeToString())
+    elements = []
+    while True:
+        reply = ForwardMsg()
+        reply.ParseFromString(await websocket.recv())
+        if reply.WhichOneof("type") == "delta" and reply.delta.WhichOneof("type") == "new_element":
+            elements.append((reply.delta.new_element, reply.delta.fragment_id))
+        elif reply.WhichOneof("type") == "script_finished":
+            return (time.perf_counter() - start) * 1000, elements
+
+
+# Function to click the first ➕ in a live browser-like session, returns (first run ms, click samples ms, elements per click)
+async def live_clicks(port, clicks):
+    import websockets
+    from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+    async with websockets.connect(f"ws://127.0.0.1:{port}/_stcore/stream", max_size=None) as websocket:
+        first_run, elements = await live_rerun(websocket)
+        button_id, fragment_id = next((element.button.id, fragment) for element, fragment in elements if element.WhichOneof("type") == "button" and element.button.label == "➕")
+        samples, sent = [], []
+        for _ in range(clicks):
+            elapsed, elements = await live_rerun(websocket, [WidgetState(id=button_id, trigger_value=True)], fragment_id)
+            samples.append(elapsed)
+            sent.append(len(elements))
+        return first_run, samples, sent
+
+
+# Function to start serve.py with some workers in a fresh copy of a working directory, returns (process, port)
+def start_workers(workdir, workers):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            sys.executable, SERVE_PATH, "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port),
+            "--", "--server.enableXsrfProtection", "false",
+        ],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 120
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return process, port
+        except OSError:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError("serve.py did not start")
+            time.sleep(0.2)
+
+
+# Function to click ➕ over one live session connected from its own loopback address, which the balancer pins to a worker
+async def balanced_clicks(port, clicks, source, start_barrier):
+    import websockets
+    from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+    async with websockets.connect(f"ws://127.0.0.1:{port}/_stcore/stream", max_size=None, local_addr=(source, 0)) as websocket:
+        # The first page also loads the catalog in a worker's first session, so it is left out of the timing
+        _, elements = await live_rerun(websocket)
+        button_id, fragment_id = next((element.button.id, fragment) for element, fragment in elements if element.WhichOneof("type") == "button" and element.button.label == "➕")
+        start_barrier.wait()
+        started = time.time()
+        samples = []
+        for _ in range(clicks):
+            elapsed, _ = await live_rerun(websocket, [WidgetState(id=button_id, trigger_value=True)], fragment_id)
+            samples.append(elapsed)
+        return {"samples": samples, "started": started, "finished": time.time()}
+
+
+# Function run in a worker process: one browser-like session against serve.py
+def balanced_worker(port, clicks, index, start_barrier, results):
+    results.put(asyncio.run(balanced_clicks(port, clicks, f"127.0.0.{index + 2}", start_barrier)))
+
+
+# Function to measure click throughput of concurrent live sessions against 1 worker and against several behind serve.py
+def bench_workers(size, workers, sessions, clicks):
+    results = []
+    for count in sorted({1, workers}):
+        process, port = start_workers(prepare_workdir(size), count)
+        try:
+            reports = run_workers("balanced_worker", sessions, port, clicks)
+        finally:
+            process.terminate()
+            process.wait()
+        samples = [sample for report in reports for sample in report["samples"]]
+        elapsed = max(report["finished"] for report in reports) - min(report["started"] for report in reports)
+        results.append({"workers": count, "clicks_per_second": len(samples) / elapsed, "click": summarize(samples)})
+    return {"size": size, "sessions": sessions, "results": results}
+
+
+# Function to time a server start and the first page of its first session, returns (start ms, first run ms)
+def time_cold_start(workdir, app_path):
+    started = time.perf_counter()
+    process, port = start_server(workdir, app_path)
+    try:
+        start_ms = (time.perf_counter() - started) * 1000
+        first_run, _, _ = asyncio.run(live_clicks(port, 0))
+        return process, start_ms, first_run
+    except BaseException:
+        process.terminate()
+        process.wait()
+        raise
+
+
+# Function to time cold starts without and then with the catalog snapshot the first start leaves behind
+def bench_startup(size, app_path):
+    workdir = prepare_workdir(size)
+    results = {"size": size}
+    for run in ("without_snapshot", "with_snapshot"):
+        process, start_ms, first_run = time_cold_start(workdir, app_path)
+        # The snapshot is written in the background after the first page; wait for it before stopping the server
+        deadline = time.time() + 120
+        while run == "without_snapshot" and not os.path.exists(os.path.join(workdir, "catalog_snapshot.index")) and time.time() < deadline:
+            time.sleep(0.2)
+        process.terminate()
+        process.wait()
+        results[run] = {"server_start_ms": start_ms, "first_page_ms": first_run, "total_ms": start_ms + first_run}
+    return results
+
+
+# Function to time ➕ clicks against a real `streamlit run` server, the way a browser drives it
+def bench_live(size, clicks, app_path):
+    workdir = prepare_workdir(size)
+    process, port = start_server(workdir, app_path)
+    try:
+        first_run, samples, sent = asyncio.run(live_clicks(port, clicks))
+    finally:
+        process.terminate()
+        process.wait()
+    return {"size": size, "first_run_ms": first_run, "click": summarize(samples), "elements_per_click": statistics.median(sent)}
+
+
+# Function to measure memory growth while several sessions are open in one process
+def bench_sessions(size, sessions):
+    workdir = prepare_workdir(size)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        gc.collect()
+        baseline = current_rss_mb()
+        apps = []
+        for _ in range(sessions):
+            apps.append(AppTest.from_file(APP_PATH, default_timeout=600).run())
+        gc.collect()
+        total = current_rss_mb() - baseline
+        return {"size": size, "sessions": sessions, "rss_growth_mb": total, "per_session_mb": total / sessions}
+    finally:
+        os.chdir(cwd)
+
+
+# Function to compare the untyped catalog (object columns, mixed int/str barcodes) with the app's typed one
+def schema_report(size, repeat):
+    workdir = prepare_workdir(size)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        at = AppTest.from_file(APP_PATH, default_timeout=600).run()
+        typed = at.session_state.products_df
+    finally:
+        os.chdir(cwd)
+
+    records = make_catalog(size)
+    # Products added through the form used to store the barcode as a string
+    for record in records[::2]:
+        record["Barcode"] = str(record["Barcode"])
+    untyped = pd.DataFrame(records).astype(object)
+
+    code = str(make_catalog(size)[size // 2]["Barcode"])
+    operations = {
+        "barcode lookup": (
+            lambda: untyped[untyped["Barcode"].astype(str) == code],
+            lambda: typed[typed["Barcode"] == int(code)],
+        ),
+        "country filter": (
+            lambda: untyped[untyped["Country"] == "Egypt"],
+            lambda: typed[typed["Country"] == "Egypt"],
+        ),
+        "name contains": (
+            lambda: untyped[untyped["Product Name"].str.contains("Product 12", case=False)],
+            lambda: typed[typed["Product Name"].str.contains("Product 12", case=False)],
+        ),
+    }
+
+    rows = [("memory (MB)", untyped.memory_usage(deep=True).sum() / 2**20, typed.memory_usage(deep=True).sum() / 2**20)]
+    for name, (old, new) in operations.items():
+        rows.append((f"{name} (ms)", statistics.median(time_ms(old, repeat)), statistics.median(time_ms(new, repeat))))
+    return rows
+
+
+# Function to time bulk repricing of every product: the vectorized computation and the batched write under the catalog lock
+def bench_reprice(size, repeat):
+    workdir = prepare_workdir(size)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        app = load_app_functions()
+        catalog = {"df": app["load_data"](), "version": 0, "lock": threading.Lock(), "change_seq": 0, "changes_since_snapshot": 0}
+        compute, apply = [], []
+        for i in range(repeat):
+            # Alternate the direction so each run changes every price
+            factor = 1.05 if i % 2 == 0 else 1 / 1.05
+            start = time.perf_counter()
+            positions, new_prices = app["reprice_catalog"](catalog["df"], [], "", factor, "Nearest 0.05")
+            compute.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            app["apply_repricing"](catalog, catalog["version"], positions, new_prices)
+            apply.append((time.perf_counter() - start) * 1000)
+        return {"size": size, "changed": len(positions), "compute": summarize(compute), "apply": summarize(apply)}
+    finally:
+        os.chdir(cwd)
+
+
+# Function to fill the orders ledger with synthetic checkouts and time the sales analytics queries on it
+def orders_report(lines, repeat, lines_per_order=5, days=90, batch_size=10000):
+    workdir = prepare_workdir(0)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        app = load_app_functions()
+        rng = random.Random(0)
+        products = make_catalog(1000)
+        start_day = time.time() - days * 86400
+
+        inserted = 0
+        insert_start = time.perf_counter()
+        while inserted < lines:
+            orders = []
+            for _ in range(min(batch_size, -(-(lines - inserted) // lines_per_order))):
+                order_lines = []
+                for product in rng.sample(products, lines_per_order):
+                    quantity = rng.randint(1, 5)
+                    order_lines.append({
+                        "part_number": product["Part Number"],
+                        "product_name": product["Product Name"],
+                        "description": product["Description"],
+                        "barcode": str(product["Barcode"]),
+                        "quantity": quantity,
+                        "unit_price": product["Price (EGP)"],
+                        "subtotal": round(product["Price (EGP)"] * quantity, 2),
+                    })
+                orders.append({"created_at": start_day + rng.uniform(0, days * 86400), "lines": order_lines})
+                inserted += lines_per_order
+            app["record_orders"](orders)
+        insert_seconds = time.perf_counter() - insert_start
+
+        today = datetime.date.today()
+        month_ago = today - datetime.timedelta(days=29)
+        first_day = today - datetime.timedelta(days=days)
+        queries = {
+            "daily revenue, 30 days": lambda: app["daily_sales"](month_ago, today),
+            "daily revenue, all days": lambda: app["daily_sales"](first_day, today),
+            "top 10 products, 30 days": lambda: app["product_sales"](month_ago, today, "revenue", 10),
+            "units per part number, all days": lambda: app["product_sales"](first_day, today, "units"),
+        }
+        return inserted, insert_seconds, [(name, statistics.median(time_ms(query, repeat))) for name, query in queries.items()]
+    finally:
+        os.chdir(cwd)
+
+
+# Function to list p50 regressions against a baseline results file
+def find_regressions(baseline, current, tolerance):
+    regressions = []
+    baseline_by_size = {result["size"]: result for result in baseline.get("sizes", [])}
+    for result in current["sizes"]:
+        before = baseline_by_size.get(result["size"])
+        if before is None:
+            continue
+        for operation, summary in result.items():
+            if not isinstance(summary, dict) or operation not in before:
+                continue
+            old, new = before[operation]["p50_ms"], summary["p50_ms"]
+            if old and new > old * (1 + tolerance):
+                regressions.append(f"{result['size']} products, {operation}: p50 {old:.1f} ms -> {new:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark deploy.py against synthetic catalogs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--concurrent", type=int, default=0, help="also load-test this many concurrent sessions")
+    parser.add_argument("--clicks", type=int, default=20, help="clicks per concurrent session")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="fail if p50 latencies regressed against this results file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown for --compare (0.25 = 25%%)")
+    parser.add_argument("--sessions", type=int, default=0, help="measure memory with this many sessions in one process")
+    parser.add_argument("--schema-report", action="store_true", help="compare untyped and typed catalog memory and latency")
+    parser.add_argument("--orders-report", type=int, metavar="LINES", help="time sales analytics over a ledger of this many order lines")
+    parser.add_argument("--contention", type=int, metavar="SESSIONS", help="have this many carts reserve the same product at once (--clicks each)")
+    parser.add_argument("--stock", type=int, help="stock on hand for --contention (default: half the attempts)")
+    parser.add_argument("--live", action="store_true", help="time ➕ clicks against a real streamlit server (--clicks each)")
+    parser.add_argument("--app", default=APP_PATH, help="app script for --live and --startup, e.g. an older deploy.py to compare against")
+    parser.add_argument("--startup", action="store_true", help="time server start and first page, without and with the catalog snapshot")
+    parser.add_argument("--workers", type=int, help="compare live click throughput of 1 and this many workers behind serve.py")
+    parser.add_argument("--reprice", action="store_true", help="time repricing every product and writing the new prices")
+    args = parser.parse_args()
+
+    # AppTest runs the script outside `streamlit run`, which logs a bare-mode warning per session
+    set_log_level("error")
+
+    if args.schema_report:
+        for size in args.sizes:
+            print(f"{size} products")
+            print(f"{'':>22} {'untyped':>10} {'typed':>10}")
+            for name, old, new in schema_report(size, args.repeat):
+                print(f"{name:>22} {old:>10.1f} {new:>10.1f}")
+        return
+
+    if args.orders_report:
+        inserted, insert_seconds, timings = orders_report(args.orders_report, args.repeat)
+        print(f"{inserted} order lines recorded in {insert_seconds:.1f} s ({inserted / insert_seconds:,.0f} lines/s)")
+        for name, elapsed in timings:
+            print(f"{name:>32} {elapsed:>9.1f} ms")
+        return
+
+    if args.startup:
+        print(f"{'products':>10} {'snapshot':>18} {'server start (ms)':>18} {'first page (ms)':>16} {'total (ms)':>11}")
+        for size in args.sizes:
+            result = bench_startup(size, os.path.abspath(args.app))
+            for run in ("without_snapshot", "with_snapshot"):
+                timing = result[run]
+                print(f"{size:>10} {run:>18} {timing['server_start_ms']:>18.0f} {timing['first_page_ms']:>16.0f} {timing['total_ms']:>11.0f}")
+        return
+
+    if args.workers:
+        sessions = args.concurrent or 4 * args.workers
+        print(f"{'products':>10} {'sessions':>10} {'workers':>8} {'clicks/s':>9} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        for size in args.sizes:
+            result = bench_workers(size, args.workers, sessions, args.clicks)
+            for run in result["results"]:
+                print(f"{size:>10} {sessions:>10} {run['workers']:>8} {run['clicks_per_second']:>9.1f} {run['click']['p50_ms']:>9.1f} {run['click']['p99_ms']:>9.1f}")
+        return
+
+    if args.reprice:
+        for size in args.sizes:
+            result = bench_reprice(size, args.repeat)
+            print(
+                f"{size} products, {result['changed']} repriced: compute p50 {result['compute']['p50_ms']:.1f} ms,"
+                f" apply p50 {result['apply']['p50_ms']:.1f} ms"
+            )
+        return
+
+    if args.live:
+        for size in args.sizes:
+            result = bench_live(size, args.clicks, os.path.abspath(args.app))
+            print(
+                f"{size} products: first run {result['first_run_ms']:.1f} ms, click p50 {result['click']['p50_ms']:.1f} ms,"
+                f" p99 {result['click']['p99_ms']:.1f} ms, {result['elements_per_click']:.0f} elements sent per click"
+            )
+        return
+
+    if args.contention:
+        result = bench_contention(args.contention, args.clicks, args.stock if args.stock is not None else args.contention * args.clicks // 2)
+        print(
+            f"{result['sessions']} carts x {args.clicks} clicks on one product with {result['stock']} in stock:"
+            f" {result['granted']} granted, {result['stored_reservations']} reserved in the store, {result['oversold']} oversold"
+        )
+        print(
+            f"  reserve p50 {result['reserve']['p50_ms']:.2f} ms, p99 {result['reserve']['p99_ms']:.2f} ms,"
+            f" {result['attempts_per_second']:,.0f} attempts/s"
+        )
+        sys.exit(1 if result["oversold"] or result["granted"] != result["stored_reservations"] else 0)
+
+    if args.sessions:
+        print(f"{'products':>10} {'sessions':>10} {'RSS growth (MB)':>16} {'per session (MB)':>18}")
+        for size in args.sizes:
+            result = bench_sessions(size, args.sessions)
+            print(f"{result['size']:>10} {result['sessions']:>10} {result['rss_growth_mb']:>16.1f} {result['per_session_mb']:>18.2f}")
+        return
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "storage": os.environ.get("INVENTORY_STORAGE", "sqlite"),
+        "sizes": [],
+        "concurrent": [],
+    }
+    for size in args.sizes:
+        result = bench_size(size, args.repeat)
+        report["sizes"].append(result)
+        print(f"{size} products (peak RSS {result['peak_rss_mb']:.0f} MB)")
+        for operation, summary in result.items():
+            if isinstance(summary, dict):
+                print(f"  {operation:>15}  p50 {summary['p50_ms']:>9.1f} ms  p99 {summary['p99_ms']:>9.1f} ms")
+        for error in result["errors"]:
+            print(f"  error: {error}")
+
+        if args.concurrent:
+            result = bench_concurrent(size, args.concurrent, args.clicks)
+            report["concurrent"].append(result)
+            print(
+                f"  {args.concurrent} concurrent sessions: click p50 {result['click']['p50_ms']:.1f} ms,"
+                f" p99 {result['click']['p99_ms']:.1f} ms, peak RSS {result['peak_rss_mb_total']:.0f} MB total"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = find_regressions(json.load(f), report, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,35 @@
 import streamlit as st
 import pandas as pd
-from collections import defaultdict
+from collections import defaultdict, deque
 import os
 import json
+import re
+import sqlite3
+import threading
+import tempfile
+import time
+import uuid
+import atexit
+import logging
+import datetime
+import hmac
+import html
+import string
+import gc
+import pickle
+import sys
+import hashlib
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager, nullcontext
+import bisect
+import io
+import importlib.util
+from array import array
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # Set page configuration
 st.set_page_config(
@@ -110,22 +137,196 @@ st.markdown("""
 # File paths for data persistence
 DATA_PATH = "inventory_data.json"
 CART_PATH = "cart_data.json"
+CART_DIR = "carts"
+DB_PATH = "inventory.db"
+
+# Storage backend for the product catalog: "sqlite" (default) or "json"
+STORAGE_BACKEND = os.environ.get("INVENTORY_STORAGE", "sqlite")
+
+# Seconds between checks for catalog and branch price changes made by other worker processes sharing the database (see serve.py)
+SHARED_STATE_POLL_INTERVAL = 1.0
+
+# Binary snapshot of the catalog (memory-mapped Arrow) and its indexes (pickle) for fast cold starts,
+# tagged with the catalog source they were built from and rewritten once the catalog has not changed for
+# CATALOG_SNAPSHOT_DELAY seconds, so a burst of edits costs one write
+CATALOG_SNAPSHOT_PATH = "catalog_snapshot.arrow"
+CATALOG_INDEX_SNAPSHOT_PATH = "catalog_snapshot.index"
+CATALOG_SNAPSHOT_DELAY = 30.0
+
+# Change history: append-only log of catalog changes plus periodic compacted snapshots
+HISTORY_DIR = "history"
+CHANGELOG_PATH = os.path.join(HISTORY_DIR, "changes.jsonl")
+SNAPSHOT_INTERVAL = 500
+SNAPSHOT_RETENTION = 5
+SNAPSHOT_NAME_PATTERN = re.compile(r"^snapshot_(\d+)_(\d+)\.json$")
+
+# Seconds between background cart writes; clicks in between are coalesced into one write
+CART_FLUSH_INTERVAL = 2.0
+CART_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Separators between barcodes in one burst of scans
+SCAN_SPLIT_PATTERN = re.compile(r"[\s,;]+")
+
+# Branches share the master catalog and keep their own price overrides and stock; a session works for the branch
+# named in its URL (?branch=...), or the server's default branch
+DEFAULT_BRANCH = os.environ.get("INVENTORY_BRANCH", "main")
+BRANCH_ID_PATTERN = re.compile(r"^[a-z0-9_-]{1,32}$")
+
+# Stock on hand and cart reservations live in SQLite, so every session and server process sees the same counts
+LOW_STOCK_THRESHOLD = int(os.environ.get("INVENTORY_LOW_STOCK", "5"))
+RESERVATION_TTL = 2 * 3600
+
+# Catalog columns, in file order; the in-memory catalog also carries each product's stable integer ID
+PRODUCT_COLUMNS = ["Part Number", "Product Name", "Description", "Country", "Price (EGP)", "Barcode"]
+CATALOG_COLUMNS = ["ID"] + PRODUCT_COLUMNS
+
+# Rows handled per chunk by bulk import and export
+IMPORT_CHUNK_SIZE = 5000
+EXPORT_CHUNK_SIZE = 5000
+
+# Supplier price lists dropped into this folder, or served at INVENTORY_PRICE_URL, are synced into the catalog in the background;
+# open pages check for catalog changes at the same interval
+PRICE_DROP_DIR = os.environ.get("INVENTORY_PRICE_DROP", "price_drop")
+PRICE_SYNC_URL = os.environ.get("INVENTORY_PRICE_URL", "")
+PRICE_SYNC_INTERVAL = 5.0
+PRICE_SYNC_HISTORY = 20
+# When several worker processes serve the app, only the one started with this set syncs price lists
+PRICE_SYNC_ENABLED = os.environ.get("INVENTORY_PRICE_SYNC", "1") == "1"
+PRICE_LIST_SUFFIXES = (".csv", ".xlsx", ".json", ".jsonl")
+
+# Rounding rules offered by bulk repricing, and how many changed rows its preview shows
+PRICE_ROUNDING_RULES = ["None", "Nearest 0.05", "Nearest pound", "End in .99", "End in 9", "End in 99"]
+REPRICE_PREVIEW_ROWS = 1000
+
+# Columns the search index is built from; a change to any other column keeps the indexes
+INDEXED_COLUMNS = ["Part Number", "Product Name", "Description", "Barcode"]
+
+# Pagination settings for the catalog and inventory lists
+PAGE_SIZE_OPTIONS = [10, 25, 50, 100]
+DEFAULT_PAGE_SIZE = 25
+
+# Process-wide LRU caches of search result pages and rendered product cards, each bounded by the bytes it holds
+SEARCH_CACHE_BYTES = 8 * 2**20
+CARD_CACHE_BYTES = 16 * 2**20
+
+# Hot-path instrumentation, off unless INVENTORY_METRICS=1; the sidebar panel needs ?admin=<INVENTORY_ADMIN_TOKEN> in the URL
+METRICS_ENABLED = os.environ.get("INVENTORY_METRICS") == "1"
+METRICS_PATH = "metrics.jsonl"
+METRICS_HISTORY = 200
+ADMIN_TOKEN = os.environ.get("INVENTORY_ADMIN_TOKEN", "")
+PROFILE_TOP_FUNCTIONS = 25
+NO_SPAN = nullcontext()
+
+# Invoices are rendered as HTML, or as PDF when weasyprint is installed, on a background worker pool
+INVOICE_WORKERS = 4
+INVOICE_CACHE_SIZE = 64
+INVOICE_POLL_INTERVAL = 0.5
+INVOICE_COUNTER_PATH = "invoice_counter.json"
+INVOICE_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html lang="ar" dir="ltr">
+<head>
+<meta charset="utf-8">
+<title>Invoice $number</title>
+<style>
+    body { font-family: "Noto Naskh Arabic", "Amiri", "Tahoma", "DejaVu Sans", sans-serif; margin: 24px; }
+    h1 { color: #4CAF50; margin-bottom: 0; }
+    table { width: 100%; border-collapse: collapse; margin-top: 16px; }
+    th, td { border-bottom: 1px solid #ccc; padding: 6px; text-align: start; vertical-align: top; }
+    td.number, th.number { text-align: end; white-space: nowrap; }
+    .total { font-size: 20px; font-weight: bold; text-align: end; margin-top: 16px; }
+</style>
+</head>
+<body>
+<h1>Invoice $number</h1>
+<div>Date: $date</div>
+<table>
+<tr><th>Product</th><th>Part Number</th><th>Barcode</th><th class="number">Quantity</th><th class="number">Unit Price (EGP)</th><th class="number">Subtotal (EGP)</th></tr>
+$lines
+</table>
+<div class="total">TOTAL: $total EGP</div>
+</body>
+</html>
+""")
+INVOICE_LINE_TEMPLATE = string.Template(
+    '<tr><td><div dir="auto"><strong>$product_name</strong></div><div dir="auto">$description</div></td>'
+    '<td>$part_number</td><td>$barcode</td><td class="number">$quantity</td>'
+    '<td class="number">$unit_price</td><td class="number">$subtotal</td></tr>'
+)
+
+# Function to get the metrics of the rerun in progress (widget callbacks run before the script, so they count towards it)
+def current_rerun_metrics():
+    if 'rerun_metrics' not in st.session_state:
+        st.session_state.rerun_metrics = {"spans": defaultdict(float), "counters": defaultdict(int)}
+    return st.session_state.rerun_metrics
+
+# Function to time a hot-path stage of the current rerun; when metrics are off it hands back a shared no-op context
+def span(name):
+    if not METRICS_ENABLED:
+        return NO_SPAN
+    return timed_span(name)
+
+# Function to add the time spent inside the with-block to a span of the current rerun
+@contextmanager
+def timed_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current_rerun_metrics()["spans"][name] += (time.perf_counter() - start) * 1000
+
+# Function to add to a counter of the current rerun (elements rendered, bytes written, ...)
+def count(name, amount=1):
+    if METRICS_ENABLED:
+        current_rerun_metrics()["counters"][name] += amount
+
+# Function to convert a catalog DataFrame to the typed schema: int64 product ID, Arrow strings, categorical country,
+# nullable int64 barcode. Rows without an ID (new products, files from before product IDs) are given the next free ones
+def normalize_catalog(df):
+    df = df.reindex(columns=CATALOG_COLUMNS)
+    ids = pd.to_numeric(df["ID"], errors='coerce')
+    missing = ids.isna()
+    if missing.any():
+        highest = ids.max()
+        first = next_product_ids(int(missing.sum()), 0 if pd.isna(highest) else int(highest))
+        ids[missing] = list(range(first, first + int(missing.sum())))
+    df["ID"] = ids.astype("int64")
+    text = pd.StringDtype("pyarrow")
+    for column in ["Part Number", "Product Name", "Description"]:
+        df[column] = df[column].fillna("").astype(text)
+    df["Country"] = df["Country"].fillna("").astype(text).astype("category")
+    df["Price (EGP)"] = pd.to_numeric(df["Price (EGP)"], errors='coerce').astype("float64").round(2)
+    if df["Barcode"].dtype != "Int64":
+        barcodes = pd.to_numeric(df["Barcode"].astype("string").str.strip(), errors='coerce')
+        df["Barcode"] = barcodes.where(barcodes % 1 == 0).astype("Int64")
+    return df
+
+# Function to convert a catalog DataFrame to JSON-friendly records (missing values become None)
+def catalog_records(df):
+    return df.astype(object).where(df.notna(), None).to_dict('records')
 
 # Function to load data from file
 def load_data():
-    if os.path.exists(DATA_PATH):
-        try:
-            with open(DATA_PATH, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return pd.DataFrame(data)
-        except Exception as e:
-            st.error(f"Error loading data: {e}")
+    with span("load_data"):
+        if STORAGE_BACKEND == "sqlite":
+            return load_data_sqlite()
+        if os.path.exists(DATA_PATH):
+            try:
+                with open(DATA_PATH, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                df = normalize_catalog(pd.DataFrame(data))
+                # A file from before product IDs keeps the ones it was just given
+                if any("ID" not in product for product in data):
+                    save_data(df)
+                return df
+            except Exception as e:
+                st.error(f"Error loading data: {e}")
+                return create_default_data()
+        else:
             return create_default_data()
-    else:
-        return create_default_data()
 
-# Function to create default data
-def create_default_data():
+# Function to create default data; products the current catalog also has keep their IDs, and so their stock,
+# reservations and branch prices
+def create_default_data(current=None):
     # Define the original product data
     original_products_data = [
         {"Part Number": "06008A7E01", "Product Name": "Easy Aquatak 100 Long Lance", "Description": "ماكينة غسيل ضغط عالي 100 بار - 1200 وات - طول الخرطوم 3 متر", "Country": "China", "Price (EGP)": 3662.22, "Barcode": 4059952539447},
@@ -143,6 +344,15 @@ def create_default_data():
     
     # Convert to DataFrame
     df = pd.DataFrame(original_products_data)
+    if current is not None and len(current):
+        ids = current['ID'].tolist()
+        matched = set()
+        product_ids = []
+        for position in match_products(current, original_products_data):
+            product_ids.append(ids[position] if position < len(current) and position not in matched else None)
+            matched.add(position)
+        df["ID"] = product_ids
+    df = normalize_catalog(df)
     
     # Save the default data to file
     save_data(df)
@@ -151,69 +361,1357 @@ def create_default_data():
 
 # Function to save data to file
 def save_data(df):
+    with span("save_data"):
+        if STORAGE_BACKEND == "sqlite":
+            return save_data_sqlite(df)
+        try:
+            with open(DATA_PATH, 'w', encoding='utf-8') as f:
+                json.dump(catalog_records(df), f, ensure_ascii=False, indent=4)
+                count("bytes_written", f.tell())
+            return True
+        except Exception as e:
+            st.error(f"Error saving data: {e}")
+            return False
+
+# Function to open a connection to the SQLite database
+def connect_db():
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+# Function to run changes in one write transaction; BEGIN IMMEDIATE takes SQLite's write lock up front,
+# so concurrent sessions and server processes check and change stock, the catalog and its change log one at a time
+@contextmanager
+def write_transaction():
+    ensure_db()
+    with closing(connect_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+# Function to reserve count new product IDs above floor, returns the first one. IDs are never reused: the counter also
+# stays above every ID the products table has handed out, and above the highest one in the catalog being numbered
+def next_product_ids(count, floor=0):
+    with write_transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('product_id', 0)")
+        last = conn.execute(
+            "UPDATE counters SET value = MAX(value, ?, (SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'products')) + ?"
+            " WHERE name = 'product_id' RETURNING value",
+            (floor, count),
+        ).fetchall()[0][0]
+    return last - count + 1
+
+# Function to convert a product dictionary into a products table row
+def product_to_row(product):
+    part_number = product["Part Number"]
+    barcode = product["Barcode"]
+    return (
+        "" if part_number is None or pd.isna(part_number) else str(part_number),
+        product["Product Name"],
+        product["Description"],
+        product["Country"],
+        float(product["Price (EGP)"]),
+        None if barcode is None or pd.isna(barcode) else barcode,
+    )
+
+# Function to list the column names of a table, empty when the table does not exist
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+# Function to create the SQLite schema and migrate the JSON file into it once
+def init_db():
+    with closing(connect_db()) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS products ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " part_number TEXT NOT NULL DEFAULT '',"
+            " product_name TEXT NOT NULL,"
+            " description TEXT,"
+            " country TEXT,"
+            " price REAL NOT NULL,"
+            # No type affinity so int barcodes and form-entered string barcodes are kept as given
+            " barcode)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_products_part_number ON products (part_number)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_products_barcode ON products (barcode)")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        
+        # Every product row carries the catalog revision that last wrote it, and deleted IDs are kept with theirs, so other
+        # worker processes read only what changed since the revision they loaded. Writes bump catalog_revision after their
+        # rows in the same transaction, so the rows take the revision it is about to reach
+        if "revision" not in table_columns(conn, "products"):
+            conn.execute("ALTER TABLE products ADD COLUMN revision INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_products_revision ON products (revision)")
+        conn.execute("CREATE TABLE IF NOT EXISTS deleted_products (id INTEGER PRIMARY KEY, revision INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_deleted_products_revision ON deleted_products (revision)")
+        next_revision = "(SELECT COALESCE(MAX(value), 0) + 1 FROM counters WHERE name = 'catalog_revision')"
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS products_inserted AFTER INSERT ON products BEGIN"
+            f" UPDATE products SET revision = {next_revision} WHERE id = NEW.id;"
+            " DELETE FROM deleted_products WHERE id = NEW.id;"
+            " END"
+        )
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS products_updated AFTER UPDATE OF part_number, product_name, description, country, price, barcode"
+            f" ON products BEGIN UPDATE products SET revision = {next_revision} WHERE id = NEW.id; END"
+        )
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS products_deleted AFTER DELETE ON products BEGIN"
+            f" INSERT OR REPLACE INTO deleted_products (id, revision) VALUES (OLD.id, {next_revision});"
+            " END"
+        )
+        
+        # Orders ledger: one header per checkout plus its lines, priced at checkout time
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS orders ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " created_at REAL NOT NULL,"
+            " cart_id TEXT,"
+            " branch TEXT,"
+            " total REAL NOT NULL,"
+            " invoice_number INTEGER)"
+        )
+        if "branch" not in table_columns(conn, "orders"):
+            conn.execute("ALTER TABLE orders ADD COLUMN branch TEXT")
+        # Orders saved before invoice numbers were stored get theirs the first time they are printed
+        if "invoice_number" not in table_columns(conn, "orders"):
+            conn.execute("ALTER TABLE orders ADD COLUMN invoice_number INTEGER")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS order_lines ("
+            " order_id INTEGER NOT NULL REFERENCES orders (id),"
+            " part_number TEXT NOT NULL DEFAULT '',"
+            " product_name TEXT NOT NULL,"
+            " description TEXT,"
+            " barcode TEXT,"
+            " quantity INTEGER NOT NULL,"
+            " unit_price REAL NOT NULL,"
+            " subtotal REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_order_id ON order_lines (order_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_part_number ON order_lines (part_number)")
+        
+        # Sales aggregates, updated in the same transaction as each order so analytics never scan order_lines
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS daily_sales ("
+            " day TEXT PRIMARY KEY,"
+            " orders INTEGER NOT NULL,"
+            " units INTEGER NOT NULL,"
+            " revenue REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS product_daily_sales ("
+            " day TEXT NOT NULL,"
+            " part_number TEXT NOT NULL,"
+            " product_name TEXT NOT NULL,"
+            " units INTEGER NOT NULL,"
+            " revenue REAL NOT NULL,"
+            " PRIMARY KEY (day, part_number, product_name))"
+        )
+        
+        # Branches and their price overrides on top of the master catalog
+        conn.execute("CREATE TABLE IF NOT EXISTS branches (id TEXT PRIMARY KEY, name TEXT NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO branches (id, name) VALUES (?, ?)", (DEFAULT_BRANCH, DEFAULT_BRANCH))
+        # Branch prices, stock and reservations from before product IDs (stock also from before branches) are keyed by part
+        # number and name; they are moved aside here and copied into the tables below by product ID, all in the
+        # transaction the branches insert opened
+        legacy = {
+            table: "branch" in table_columns(conn, table)
+            for table in ("branch_prices", "stock", "reservations")
+            if table_columns(conn, table) and "product_id" not in table_columns(conn, table)
+        }
+        for table in legacy:
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_by_name")
+        
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS branch_prices ("
+            " branch TEXT NOT NULL,"
+            " product_id INTEGER NOT NULL,"
+            " price REAL NOT NULL,"
+            " PRIMARY KEY (branch, product_id))"
+        )
+        # Stock on hand per branch and product; products without a row are not stock-tracked in that branch
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stock ("
+            " branch TEXT NOT NULL,"
+            " product_id INTEGER NOT NULL,"
+            " on_hand INTEGER NOT NULL,"
+            " PRIMARY KEY (branch, product_id))"
+        )
+        # Stock held by carts until checkout; a reservation not touched for RESERVATION_TTL seconds no longer holds stock
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS reservations ("
+            " cart_id TEXT NOT NULL,"
+            " branch TEXT NOT NULL,"
+            " product_id INTEGER NOT NULL,"
+            " quantity INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (cart_id, product_id))"
+        )
+        if legacy:
+            # The JSON backend's catalog is its file; the products table only has what was migrated from it
+            keys = conn.execute("SELECT id, part_number, product_name FROM products").fetchall()
+            if STORAGE_BACKEND != "sqlite" and os.path.exists(DATA_PATH):
+                with open(DATA_PATH, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if all("ID" in product for product in data):
+                    keys = [(product["ID"], catalog_text(product.get("Part Number")), product.get("Product Name")) for product in data]
+            conn.execute("CREATE TEMP TABLE product_keys (id INTEGER, part_number TEXT, product_name TEXT)")
+            conn.executemany("INSERT INTO product_keys (id, part_number, product_name) VALUES (?, ?, ?)", keys)
+            # A key shared by several products goes to the first of them, the way old cart keys do; keys no product has are dropped
+            product_ids = "(SELECT MIN(id) AS id, part_number, product_name FROM product_keys GROUP BY part_number, product_name) k"
+            copies = {
+                "branch_prices": "INSERT OR IGNORE INTO branch_prices (branch, product_id, price) SELECT {branch}, k.id, o.price",
+                "stock": "INSERT OR IGNORE INTO stock (branch, product_id, on_hand) SELECT {branch}, k.id, o.on_hand",
+                "reservations": (
+                    "INSERT OR IGNORE INTO reservations (cart_id, branch, product_id, quantity, updated_at)"
+                    " SELECT o.cart_id, {branch}, k.id, o.quantity, o.updated_at"
+                ),
+            }
+            for table, branched in legacy.items():
+                conn.execute(
+                    copies[table].format(branch="o.branch" if branched else "?")
+                    + f" FROM {table}_by_name o JOIN {product_ids} ON k.part_number = o.part_number AND k.product_name = o.product_name",
+                    () if branched else (DEFAULT_BRANCH,),
+                )
+                conn.execute(f"DROP TABLE {table}_by_name")
+            conn.execute("DROP TABLE product_keys")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_product ON reservations (branch, product_id)")
+        # Serves the cross-branch lookups, which ask every branch about one product
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_product ON stock (product_id)")
+        
+        # user_version marks the one-shot migration so it never runs twice
+        if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            if os.path.exists(DATA_PATH):
+                with open(DATA_PATH, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                # Files from before product IDs leave the id to AUTOINCREMENT
+                conn.executemany(
+                    "INSERT INTO products (id, part_number, product_name, description, country, price, barcode) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(product.get("ID"), *product_to_row(product)) for product in data],
+                )
+                bump_revision(conn, "catalog_revision")
+            conn.execute("PRAGMA user_version = 1")
+
+# Function to read a change counter, 0 before its first change
+def read_revision(conn, name):
+    row = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+# Function to hold, per server process, the counter revisions its in-memory catalog and branch prices reflect
+@st.cache_resource
+def get_loaded_revisions():
+    return {}
+
+# Function to count a change to the products ('catalog_revision') or branch prices ('branch_prices_revision'), inside the
+# caller's transaction, so catalog snapshots and other worker processes can tell. When the caller also applies the change
+# in memory, under the catalog lock, a change on top of the revision this process has loaded keeps it current; otherwise,
+# or on top of another worker's change, this process is left behind and reloads
+def bump_revision(conn, name, applied_here=True):
+    conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", (name,))
+    revision = conn.execute("UPDATE counters SET value = value + 1 WHERE name = ? RETURNING value", (name,)).fetchall()[0][0]
+    loaded = get_loaded_revisions()
+    if applied_here and loaded.get(name) == revision - 1:
+        loaded[name] = revision
+
+# Function to create the SQLite schema once per server process, for the tables used outside the catalog
+@st.cache_resource
+def ensure_db():
+    init_db()
+
+# Function to read every product row from the SQLite database, or only those written after a catalog revision
+def read_products(conn, since_revision=None):
+    return pd.read_sql_query(
+        "SELECT id AS 'ID', part_number AS 'Part Number', product_name AS 'Product Name', description AS 'Description',"
+        " country AS 'Country', price AS 'Price (EGP)', barcode AS 'Barcode' FROM products"
+        + (" WHERE revision > ?" if since_revision is not None else "") + " ORDER BY id",
+        conn,
+        params=(since_revision,) if since_revision is not None else None,
+    )
+
+# Function to load data from the SQLite database
+def load_data_sqlite():
+    try:
+        init_db()
+        with closing(connect_db()) as conn:
+            df = read_products(conn)
+    except Exception as e:
+        st.error(f"Error loading data: {e}")
+        return create_default_data()
+    if df.empty:
+        return create_default_data()
+    return normalize_catalog(df)
+
+# Function to replace every product in the SQLite database
+def save_data_sqlite(df):
     try:
-        with open(DATA_PATH, 'w', encoding='utf-8') as f:
-            json.dump(df.to_dict('records'), f, ensure_ascii=False, indent=4)
+        with write_transaction() as conn:
+            # Replacing every product from a catalog that is behind another worker's change would undo that change
+            loaded = get_loaded_revisions().get("catalog_revision")
+            if loaded is not None and read_revision(conn, "catalog_revision") != loaded:
+                st.error("The catalog was just changed by another worker process; try again in a moment")
+                return False
+            conn.execute("DELETE FROM products")
+            conn.executemany(
+                "INSERT INTO products (id, part_number, product_name, description, country, price, barcode) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(product["ID"], *product_to_row(product)) for product in catalog_records(df)],
+            )
+            bump_revision(conn, "catalog_revision")
+            # Products the new catalog no longer has take their stock, reservations and branch prices with them, as in delete_stock
+            conn.execute("DELETE FROM stock WHERE product_id NOT IN (SELECT id FROM products)")
+            conn.execute("DELETE FROM reservations WHERE product_id NOT IN (SELECT id FROM products)")
+            if conn.execute("DELETE FROM branch_prices WHERE product_id NOT IN (SELECT id FROM products)").rowcount:
+                bump_revision(conn, "branch_prices_revision", applied_here=False)
+        count("rows_written", len(df))
         return True
     except Exception as e:
         st.error(f"Error saving data: {e}")
         return False
 
+# Function to store one new product (df is the catalog including it, used by the JSON backend)
+def insert_product(product, df):
+    if STORAGE_BACKEND != "sqlite":
+        return save_data(df)
+    try:
+        with closing(connect_db()) as conn, conn:
+            conn.execute(
+                "INSERT INTO products (id, part_number, product_name, description, country, price, barcode) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (product["ID"], *product_to_row(product)),
+            )
+            bump_revision(conn, "catalog_revision")
+        return True
+    except Exception as e:
+        st.error(f"Error saving data: {e}")
+        return False
+
+# Function to remove one product from storage (df is the catalog without it, used by the JSON backend)
+def delete_product_rows(product_id, df):
+    if STORAGE_BACKEND != "sqlite":
+        return save_data(df)
+    try:
+        with closing(connect_db()) as conn, conn:
+            conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+            bump_revision(conn, "catalog_revision")
+        return True
+    except Exception as e:
+        st.error(f"Error saving data: {e}")
+        return False
+
+# Function to get the cart file path for a cart id
+def cart_path(cart_id):
+    return os.path.join(CART_DIR, f"{cart_id}.json")
+
+# Function to write JSON crash-safely: write a temp file, fsync it, then atomically rename it into place; returns the bytes written
+def write_json_atomic(path, data):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=".json")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return len(payload)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 # Function to load cart data
-def load_cart():
-    if os.path.exists(CART_PATH):
+def load_cart(cart_id):
+    # A write still waiting in the cart writer is newer than the file on disk
+    writer = get_cart_writer()
+    with writer["lock"]:
+        pending = writer["pending"].get(cart_id)
+    if pending is not None:
+        return defaultdict(int, pending[1])
+    
+    path = cart_path(cart_id)
+    # The first new cart adopts the old shared cart file; os.replace lets only one session win
+    if not os.path.exists(path) and os.path.exists(CART_PATH):
         try:
-            with open(CART_PATH, 'r') as f:
+            os.makedirs(CART_DIR, exist_ok=True)
+            os.replace(CART_PATH, path)
+        except OSError:
+            pass
+    
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
                 cart_data = json.load(f)
-                # Convert keys back to the format used by the app
-                quantities = defaultdict(int)
-                for key, value in cart_data.items():
-                    quantities[key] = value
-                return quantities
+            quantities, migrated = cart_quantities(cart_data)
+            if migrated:
+                flush_cart(cart_id, quantities)
+            return quantities
         except Exception as e:
             st.error(f"Error loading cart: {e}")
             return defaultdict(int)
     else:
         return defaultdict(int)
 
+# Function to convert stored cart keys back to product IDs, returns (quantities, whether any key was migrated).
+# Carts from before product IDs are keyed "<part number>_<product name>", which cannot be split reliably when a part
+# number contains "_", so those keys are matched against the catalog as whole strings; products no longer in it are dropped
+def cart_quantities(cart_data):
+    quantities = defaultdict(int)
+    legacy = {}
+    for key, qty in cart_data.items():
+        if key.isdigit():
+            quantities[int(key)] = qty
+        else:
+            legacy[key] = qty
+    if legacy:
+        df = get_shared_catalog()["df"]
+        ids = {}
+        for product_id, part_number, product_name in zip(df['ID'].tolist(), df['Part Number'], df['Product Name']):
+            # Keep the first product for duplicate keys, the one the old key resolved to
+            ids.setdefault(f"{part_number}_{product_name}", product_id)
+        for key, qty in legacy.items():
+            if key in ids:
+                quantities[ids[key]] += qty
+    return quantities, bool(legacy)
+
 # Function to save cart data
-def save_cart(quantities):
+def save_cart(cart_id, quantities, generation):
+    with span("save_cart"):
+        try:
+            count("bytes_written", write_cart_version(get_cart_writer(), cart_id, generation, dict(quantities)) or 0)
+            return True
+        except Exception as e:
+            st.error(f"Error saving cart: {e}")
+            return False
+
+# Function to start the process-wide cart writer that coalesces cart saves
+@st.cache_resource
+def get_cart_writer():
+    writer = {"pending": {}, "lock": threading.Lock(), "generation": 0, "cart_locks": {}, "written": {}, "writes": 0, "bytes_written": 0}
+    threading.Thread(target=run_cart_writer, args=(writer,), daemon=True).start()
+    atexit.register(flush_pending_carts, writer)
+    return writer
+
+# Function run by the cart writer thread
+def run_cart_writer(writer):
+    while True:
+        time.sleep(CART_FLUSH_INTERVAL)
+        flush_pending_carts(writer)
+
+# Function to write one version of a cart, returns the bytes written, or None when a newer version is already on disk.
+# Every save takes a generation number from the writer, and writes of one cart are serialized by a per-cart lock,
+# so a background write that lost the race with a checkout or Clear Cart cannot bring the old cart back
+def write_cart_version(writer, cart_id, generation, quantities):
+    with writer["lock"]:
+        cart_lock = writer["cart_locks"].setdefault(cart_id, threading.Lock())
+    with cart_lock:
+        if writer["written"].get(cart_id, 0) >= generation:
+            return None
+        written = write_json_atomic(cart_path(cart_id), quantities)
+        writer["written"][cart_id] = generation
+        return written
+
+# Function to write every pending cart to disk
+def flush_pending_carts(writer):
+    with writer["lock"]:
+        pending, writer["pending"] = writer["pending"], {}
+    for cart_id, (generation, quantities) in pending.items():
+        try:
+            written = write_cart_version(writer, cart_id, generation, quantities)
+            if written is None:
+                continue
+            # The writer thread has no session, so its writes are counted on the writer itself
+            with writer["lock"]:
+                writer["writes"] += 1
+                writer["bytes_written"] += written
+        except Exception:
+            logging.exception("Error saving cart %s", cart_id)
+            # Retry on the next tick unless a newer version was queued meanwhile
+            with writer["lock"]:
+                writer["pending"].setdefault(cart_id, (generation, quantities))
+
+# Function to queue a cart save; repeated saves within one flush interval cost a single write
+def schedule_cart_save(cart_id, quantities):
+    writer = get_cart_writer()
+    with writer["lock"]:
+        writer["generation"] += 1
+        writer["pending"][cart_id] = (writer["generation"], dict(quantities))
+
+# Function to write a cart to disk right away, dropping any queued save for it
+def flush_cart(cart_id, quantities):
+    writer = get_cart_writer()
+    with writer["lock"]:
+        writer["pending"].pop(cart_id, None)
+        writer["generation"] += 1
+        generation = writer["generation"]
+    return save_cart(cart_id, quantities, generation)
+
+# Function to hold, per server process, the session that has each cart open. serve.py pins a client address to one
+# worker, so a duplicated tab or a till URL opened twice reaches the process that has the cart open
+@st.cache_resource
+def get_open_carts():
+    return {"sessions": {}, "lock": threading.Lock()}
+
+# Function to open a cart for this session, returns False when another connected session has it open already.
+# A reloaded page starts a new session once the old one has disconnected, so it gets its cart back
+def claim_cart(cart_id):
+    session_id = get_script_run_ctx().session_id
+    open_carts = get_open_carts()
+    with open_carts["lock"]:
+        sessions = open_carts["sessions"]
+        for open_cart_id, owner in list(sessions.items()):
+            if owner != session_id and not runtime.get_instance().is_active_session(owner):
+                del sessions[open_cart_id]
+        if sessions.get(cart_id, session_id) != session_id:
+            return False
+        sessions[cart_id] = session_id
+    return True
+
+# Function to build the product index (product ID -> row position)
+def build_product_index(df):
+    return dict(zip(df['ID'].tolist(), range(len(df))))
+
+# Function to look up a product row by its ID
+def get_product(product_id):
+    position = st.session_state.product_index.get(product_id)
+    # The shared index may already hold rows appended after this session's snapshot
+    if position is None or position >= len(st.session_state.products_df):
+        return None
+    return st.session_state.products_df.iloc[position]
+
+# Function to look up a product price by its ID
+def get_product_price(product_id):
+    position = st.session_state.product_index.get(product_id)
+    if position is None or position >= len(st.session_state.products_df):
+        return None
+    return float(st.session_state.products_df['Price (EGP)'].iat[position])
+
+# Search index settings
+SEARCH_GRAM_SIZE = 3
+ARABIC_DIACRITICS = re.compile("[\u064B-\u065F\u0670\u0640]")
+ARABIC_LETTER_FOLDING = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4", "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+})
+ARABIC_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال")
+ARABIC_PREFIX_STARTS = tuple({prefix[0] for prefix in ARABIC_PREFIXES})
+SEARCH_TOKEN_PATTERN = re.compile(r"\w+")
+
+# Function to turn a catalog value into plain text (barcodes may be stored as int, float or str)
+def catalog_text(value):
+    if isinstance(value, str):
+        return value
+    if value is None or pd.isna(value):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+# Function to turn a barcode (stored, scanned or imported) into its lookup key; barcodes are stored as integers,
+# so leading zeros are not part of the key
+def barcode_key(value):
+    barcode = catalog_text(value).strip()
+    return str(int(barcode)) if barcode.isdigit() else barcode
+
+# Function to normalize text for searching (case folding plus Arabic letter folding)
+def normalize_search_text(value):
+    text = ARABIC_DIACRITICS.sub("", catalog_text(value))
+    return text.translate(ARABIC_LETTER_FOLDING).casefold()
+
+# Function to split normalized text into search tokens, adding Arabic words without their article prefix
+def tokenize_search_text(text):
+    tokens = []
+    for word in SEARCH_TOKEN_PATTERN.findall(text):
+        tokens.append(word)
+        if not word.startswith(ARABIC_PREFIX_STARTS):
+            continue
+        for prefix in ARABIC_PREFIXES:
+            if word.startswith(prefix) and len(word) - len(prefix) >= 2:
+                tokens.append(word[len(prefix):])
+                break
+    return tokens
+
+# Function to create an empty search index
+def new_search_index():
+    return {
+        "names": [],
+        "part_numbers": [],
+        "barcodes": [],
+        "description_tokens": [],
+        "name_grams": {},
+        "part_number_grams": {},
+        "barcode_grams": {},
+        "token_postings": {},
+        "token_vocabulary": [],
+        "barcode_exact": {},
+    }
+
+# Function to register every n-gram of a text in a posting map
+def add_grams(grams, text, position):
+    for gram in {text[i:i + SEARCH_GRAM_SIZE] for i in range(len(text) - SEARCH_GRAM_SIZE + 1)}:
+        postings = grams.get(gram)
+        if postings is None:
+            postings = grams[gram] = array("I")
+        postings.append(position)
+
+# Function to add one product to the search index
+def add_to_search_index(index, position, part_number, product_name, description, barcode, keep_vocabulary_sorted=True):
+    name = normalize_search_text(product_name)
+    part_number = normalize_search_text(part_number)
+    barcode = catalog_text(barcode)
+    tokens = tuple(dict.fromkeys(tokenize_search_text(normalize_search_text(description))))
+    
+    index["names"].append(name)
+    index["part_numbers"].append(part_number)
+    index["barcodes"].append(barcode)
+    index["description_tokens"].append(tokens)
+    
+    add_grams(index["name_grams"], name, position)
+    add_grams(index["part_number_grams"], part_number, position)
+    add_grams(index["barcode_grams"], barcode, position)
+    index["barcode_exact"].setdefault(barcode, []).append(position)
+    
+    for token in tokens:
+        postings = index["token_postings"].get(token)
+        if postings is None:
+            postings = index["token_postings"][token] = array("I")
+            if keep_vocabulary_sorted:
+                bisect.insort(index["token_vocabulary"], token)
+        postings.append(position)
+
+# Function to build the search index for a whole catalog
+def build_search_index(df):
+    index = new_search_index()
+    columns = zip(df['Part Number'].tolist(), df['Product Name'].tolist(), df['Description'].tolist(), df['Barcode'].tolist())
+    for position, (part_number, product_name, description, barcode) in enumerate(columns):
+        add_to_search_index(index, position, part_number, product_name, description, barcode, keep_vocabulary_sorted=False)
+    # Sort the vocabulary once instead of inserting token by token
+    index["token_vocabulary"] = sorted(index["token_postings"])
+    return index
+
+# Function to find rows whose text contains the query, using the rarest n-gram as the candidate list
+def find_substring_matches(texts, grams, query):
+    if len(query) < SEARCH_GRAM_SIZE:
+        return [position for position, text in enumerate(texts) if query in text]
+    
+    rarest = None
+    for i in range(len(query) - SEARCH_GRAM_SIZE + 1):
+        postings = grams.get(query[i:i + SEARCH_GRAM_SIZE])
+        if postings is None:
+            return []
+        if rarest is None or len(postings) < len(rarest):
+            rarest = postings
+    return [position for position in rarest if query in texts[position]]
+
+# Function to find rows whose description has a token starting with every query word
+def find_description_matches(index, query):
+    words = []
+    for word in SEARCH_TOKEN_PATTERN.findall(query):
+        stripped = tokenize_search_text(word)
+        words.append(stripped[-1])
+    if not words:
+        return []
+    
+    # Collect the postings of the most selective word, then check the others row by row
+    vocabulary = index["token_vocabulary"]
+    best_word, best_tokens, best_count = None, None, None
+    for word in words:
+        start = bisect.bisect_left(vocabulary, word)
+        end = bisect.bisect_left(vocabulary, word + "\uffff", start)
+        count = sum(len(index["token_postings"][token]) for token in vocabulary[start:end])
+        if best_count is None or count < best_count:
+            best_word, best_tokens, best_count = word, vocabulary[start:end], count
+    if not best_count:
+        return []
+    
+    candidates = set()
+    for token in best_tokens:
+        candidates.update(index["token_postings"][token])
+    
+    other_words = [word for word in words if word != best_word]
+    return [
+        position for position in candidates
+        if all(any(token.startswith(word) for token in index["description_tokens"][position]) for word in other_words)
+    ]
+
+# Function to search the catalog and return matching row positions, best matches first
+def search_catalog(index, query, search_type):
+    query = normalize_search_text(query.strip())
+    if not query:
+        return []
+    
+    if search_type == "Barcode":
+        texts, grams = index["barcodes"], index["barcode_grams"]
+    elif search_type == "Part Number":
+        texts, grams = index["part_numbers"], index["part_number_grams"]
+    else:
+        texts, grams = index["names"], index["name_grams"]
+    
+    # Rank: exact match, prefix match, word prefix match, substring match, description match
+    ranks = {}
+    for position in find_substring_matches(texts, grams, query):
+        text = texts[position]
+        if text == query:
+            ranks[position] = 0
+        elif text.startswith(query):
+            ranks[position] = 1
+        elif search_type == "Name/Description" and f" {query}" in f" {text}":
+            ranks[position] = 2
+        else:
+            ranks[position] = 3
+    
+    if search_type == "Name/Description":
+        for position in find_description_matches(index, query):
+            ranks.setdefault(position, 4)
+    
+    return sorted(ranks, key=lambda position: (ranks[position], position))
+
+# Function to identify the SQLite catalog at a revision; the inode tells a recreated database apart from the one
+# the snapshot was taken from
+def sqlite_source_stamp(revision):
+    return f"sqlite:{os.stat(DB_PATH).st_ino}:{revision}"
+
+# Function to identify the current state of the catalog source, or None when there is nothing to load yet
+def catalog_source_stamp():
+    if STORAGE_BACKEND == "sqlite":
+        init_db()
+        with closing(connect_db()) as conn:
+            revision = read_revision(conn, "catalog_revision")
+        return sqlite_source_stamp(revision)
+    if not os.path.exists(DATA_PATH):
+        return None
+    stat = os.stat(DATA_PATH)
+    return f"json:{stat.st_mtime_ns}:{stat.st_size}"
+
+# Function to load the catalog and its indexes from the snapshot, returns None when it is missing or was taken from another source state
+def load_catalog_snapshot(stamp):
+    if stamp is None or not os.path.exists(CATALOG_SNAPSHOT_PATH) or not os.path.exists(CATALOG_INDEX_SNAPSHOT_PATH):
+        return None
+    import pyarrow
+    import pyarrow.ipc
     try:
-        with open(CART_PATH, 'w') as f:
-            json.dump(dict(quantities), f)
-        return True
+        with span("load_snapshot"):
+            with pyarrow.memory_map(CATALOG_SNAPSHOT_PATH) as source:
+                table = pyarrow.ipc.open_file(source).read_all()
+            if (table.schema.metadata or {}).get(b"source") != stamp.encode():
+                return None
+            # A snapshot from before product IDs indexes products by part number and name
+            if "ID" not in table.column_names:
+                return None
+            with open(CATALOG_INDEX_SNAPSHOT_PATH, 'rb') as f:
+                # The stamp heads the file, so indexes taken from another source state are never unpickled
+                if f.readline().rstrip(b"\n") != stamp.encode():
+                    return None
+                # Unpickling the indexes allocates millions of small objects that hold no reference cycles
+                gc.disable()
+                try:
+                    indexes = pickle.load(f)
+                finally:
+                    gc.enable()
+            return normalize_catalog(table.to_pandas()), indexes["product_index"], indexes["search_index"]
     except Exception as e:
-        st.error(f"Error saving cart: {e}")
+        logging.warning("Ignoring unreadable catalog snapshot: %s", e)
+        return None
+
+# Function to write the snapshot of the catalog as it is now, returns the catalog version written, or None when the catalog
+# is behind its source (another worker's change is still to be applied) or changed while the snapshot was built
+def write_catalog_snapshot(catalog):
+    import pyarrow
+    import pyarrow.ipc
+    try:
+        with catalog["lock"]:
+            version = catalog["version"]
+            df, product_index, search_index = catalog["df"], catalog["product_index"], catalog["search_index"]
+            if STORAGE_BACKEND == "sqlite":
+                with closing(connect_db()) as conn:
+                    revision = read_revision(conn, "catalog_revision")
+                if revision != get_loaded_revisions().get("catalog_revision"):
+                    return None
+                stamp = sqlite_source_stamp(revision)
+            else:
+                stamp = catalog_source_stamp()
+                if stamp is None:
+                    return None
+        
+        # Built without the lock; changes that land meanwhile bump the version and the snapshot is dropped below
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        indexes = pickle.dumps({"product_index": product_index, "search_index": search_index}, protocol=pickle.HIGHEST_PROTOCOL)
+        with catalog["lock"]:
+            if catalog["version"] != version:
+                return None
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"source": stamp.encode()})
+        
+        # Same temp-file-then-rename as write_json_atomic, so a reader never sees half a snapshot
+        fd, tmp_path = tempfile.mkstemp(dir=".", prefix=".tmp_", suffix=".arrow")
+        os.close(fd)
+        with pyarrow.OSFile(tmp_path, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, CATALOG_SNAPSHOT_PATH)
+        fd, tmp_path = tempfile.mkstemp(dir=".", prefix=".tmp_", suffix=".index")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(stamp.encode() + b"\n")
+            f.write(indexes)
+        os.replace(tmp_path, CATALOG_INDEX_SNAPSHOT_PATH)
+        return version
+    except Exception as e:
+        logging.warning("Could not write the catalog snapshot: %s", e)
+        return None
+
+# Function run by the catalog snapshot thread: write the snapshot when none matches the catalog, then rewrite it once the
+# catalog has stopped changing for CATALOG_SNAPSHOT_DELAY seconds
+def run_catalog_snapshots(catalog, written_version):
+    if written_version is None:
+        written_version = write_catalog_snapshot(catalog)
+    seen_version, seen_at = written_version, time.monotonic()
+    while True:
+        time.sleep(SHARED_STATE_POLL_INTERVAL)
+        with catalog["lock"]:
+            version = catalog["version"]
+        if version == written_version:
+            continue
+        if version != seen_version:
+            seen_version, seen_at = version, time.monotonic()
+        elif time.monotonic() - seen_at >= CATALOG_SNAPSHOT_DELAY:
+            written = write_catalog_snapshot(catalog)
+            if written is not None:
+                written_version = written
+            # Behind another worker's change, or changed meanwhile; wait for the catalog to settle again
+            seen_at = time.monotonic()
+
+# Function to load the catalog once per server process and share it between sessions.
+# A fresh snapshot skips parsing the source and building the indexes; the snapshot thread writes a new one in the
+# background when it is missing or stale, and again after the catalog changes
+@st.cache_resource
+def get_shared_catalog():
+    stamp = catalog_source_stamp()
+    snapshot = load_catalog_snapshot(stamp)
+    if snapshot is not None:
+        df, product_index, search_index = snapshot
+        count("catalog_snapshot_hits")
+    else:
+        df = load_data()
+        product_index = build_product_index(df)
+        search_index = build_search_index(df)
+    catalog = {
+        "df": df,
+        "product_index": product_index,
+        "search_index": search_index,
+        "version": 0,
+        "lock": threading.Lock(),
+    }
+    if STORAGE_BACKEND == "sqlite":
+        # The stamp was taken before loading, so a change another worker made meanwhile is reloaded on the next check
+        get_loaded_revisions()["catalog_revision"] = int(stamp.rsplit(":", 1)[1])
+    init_history(catalog)
+    threading.Thread(target=run_catalog_snapshots, args=(catalog, 0 if snapshot is not None else None), daemon=True, name="catalog-snapshot").start()
+    return catalog
+
+# Function to replace the shared catalog and bump its version (the caller holds the lock)
+def replace_catalog(catalog, df):
+    catalog["df"] = df
+    catalog["product_index"] = build_product_index(df)
+    catalog["search_index"] = build_search_index(df)
+    catalog["version"] += 1
+
+# Function to change the shared catalog without holding its lock while the change is built, so sessions keep rerunning.
+# build(current) computes the change from a copy of the catalog as it is, or returns None when there is nothing to change;
+# commit(change) writes it and swaps it in under the lock, and its result is returned. When another change got in
+# meanwhile, the change is built again from the catalog that change produced, this time under the lock, so steady edits
+# elsewhere cannot keep it from landing. A change computed against a given version is dropped instead, returning None
+def update_catalog(catalog, build, commit, version=None):
+    hold_lock = False
+    while True:
+        with catalog["lock"]:
+            if version is not None and catalog["version"] != version:
+                return None
+            current = dict(catalog)
+            if hold_lock:
+                change = build(current)
+                return None if change is None else commit(change)
+        change = build(current)
+        if change is None:
+            return None
+        with catalog["lock"]:
+            if catalog["version"] == current["version"]:
+                return commit(change)
+        hold_lock = True
+
+# Function to list the branches as {branch id: name}
+def get_branches():
+    ensure_db()
+    with closing(connect_db()) as conn:
+        return dict(conn.execute("SELECT id, name FROM branches ORDER BY id").fetchall())
+
+# Function to add a branch, returns an error message or None
+def add_branch(branch, name):
+    if not BRANCH_ID_PATTERN.match(branch):
+        return "Branch ID must be 1-32 lowercase letters, digits, '-' or '_'"
+    with write_transaction() as conn:
+        if conn.execute("SELECT 1 FROM branches WHERE id = ?", (branch,)).fetchone() is not None:
+            return f"Branch {branch} already exists"
+        conn.execute("INSERT INTO branches (id, name) VALUES (?, ?)", (branch, name.strip() or branch))
+    return None
+
+# Function to load one branch's price overrides once per server process, shared by every session of that branch
+@st.cache_resource
+def get_branch_prices(branch):
+    ensure_db()
+    with closing(connect_db()) as conn:
+        revision = read_revision(conn, "branch_prices_revision")
+        rows = conn.execute("SELECT product_id, price FROM branch_prices WHERE branch = ?", (branch,)).fetchall()
+    branch_prices = {
+        "prices": dict(rows),
+        "version": 0,
+        "view": None,
+        "view_version": None,
+    }
+    # Keep the oldest revision a loaded branch reflects, so a change made while branches were loading is still reloaded
+    get_loaded_revisions().setdefault("branch_prices_revision", revision)
+    get_shared_state_watcher()["branch_prices"][branch] = branch_prices
+    return branch_prices
+
+# Function to get the catalog as a branch sees it, built once per catalog or price change (the caller holds the catalog lock).
+# Only the price column is the branch's own; the other columns and both indexes are the master catalog's
+def branch_catalog_view(catalog, branch_prices):
+    version = (catalog["version"], branch_prices["version"])
+    if branch_prices["view_version"] != version:
+        df = catalog["df"]
+        if branch_prices["prices"]:
+            # Overrides are kept per product ID, so the product index finds their rows
+            prices = df['Price (EGP)'].to_numpy(copy=True)
+            for product_id, price in branch_prices["prices"].items():
+                position = catalog["product_index"].get(product_id)
+                if position is not None:
+                    prices[position] = price
+            df = df.assign(**{'Price (EGP)': prices})
+        branch_prices["view"] = df
+        branch_prices["view_version"] = version
+    return branch_prices["view"]
+
+# Function to point this session at the latest shared catalog with its branch's prices, returns True if it changed
+def sync_catalog():
+    catalog = get_shared_catalog()
+    branch_prices = get_branch_prices(st.session_state.branch)
+    if st.session_state.get('catalog_version') == (catalog["version"], branch_prices["version"]):
+        return False
+    with catalog["lock"]:
+        st.session_state.products_df = branch_catalog_view(catalog, branch_prices)
+        st.session_state.product_index = catalog["product_index"]
+        st.session_state.search_index = catalog["search_index"]
+        st.session_state.catalog_version = (catalog["version"], branch_prices["version"])
+    return True
+
+# Function to start, once per server process, the thread that picks up catalog and branch price changes made by other
+# worker processes; sessions then see them through sync_catalog and watch_catalog like any change made here
+@st.cache_resource
+def get_shared_state_watcher():
+    watcher = {"catalog": get_shared_catalog(), "branch_prices": {}, "revisions": get_loaded_revisions()}
+    if STORAGE_BACKEND == "sqlite":
+        threading.Thread(target=run_shared_state_watcher, args=(watcher,), daemon=True, name="shared-state-watcher").start()
+    return watcher
+
+# Function run by the shared-state watcher thread: compare the change counters with the revisions this process has loaded
+def run_shared_state_watcher(watcher):
+    while True:
+        time.sleep(SHARED_STATE_POLL_INTERVAL)
+        try:
+            # Writes made in this process hold the catalog lock until they are committed and in memory, so under it
+            # they never look like another worker's
+            with watcher["catalog"]["lock"], closing(connect_db()) as conn:
+                revisions = dict(conn.execute("SELECT name, value FROM counters WHERE name IN ('catalog_revision', 'branch_prices_revision')").fetchall())
+            if revisions.get("catalog_revision", 0) != watcher["revisions"].get("catalog_revision"):
+                reload_catalog(watcher)
+            if revisions.get("branch_prices_revision", 0) != watcher["revisions"].get("branch_prices_revision", 0):
+                reload_branch_prices(watcher)
+        except Exception:
+            logging.exception("Error reloading state changed by another worker")
+
+# Function to read the catalog revision with the product rows written and the product IDs deleted after a revision,
+# returns (revision, product records, deleted IDs); an ID deleted and added again is only in the records
+def read_product_changes(since_revision):
+    with closing(connect_db()) as conn:
+        # One read transaction, so the rows and deletions are those of the revision read
+        conn.execute("BEGIN")
+        revision = read_revision(conn, "catalog_revision")
+        products = catalog_records(normalize_catalog(read_products(conn, since_revision)))
+        deleted = {product_id for (product_id,) in conn.execute("SELECT id FROM deleted_products WHERE revision > ?", (since_revision,))}
+    return revision, products, deleted - {product["ID"] for product in products}
+
+# Function to merge product records read by ID, and deleted IDs, into a catalog; returns None when the catalog already has
+# them, otherwise (merged catalog, new products, whether the indexes need rebuilding). New products are appended like a
+# local add; a deletion moves rows and a change to searched text moves postings, so those need new indexes
+def merge_product_changes(df, product_index, products, deleted):
+    positions = [product_index.get(product["ID"]) for product in products]
+    current = iter(catalog_records(df.iloc[[position for position in positions if position is not None]]))
+    updates = {}
+    inserts = []
+    reindex = False
+    for product, position in zip(products, positions):
+        if position is None:
+            inserts.append(product)
+            continue
+        changed = [column for column, value in next(current).items() if product[column] != value]
+        if changed:
+            updates[position] = product
+            reindex = reindex or any(column in INDEXED_COLUMNS for column in changed)
+    dropped = [product_index[product_id] for product_id in deleted if product_id in product_index]
+    if not updates and not inserts and not dropped:
+        return None
+    
+    df = merge_price_list(df, updates, inserts)
+    if dropped:
+        df = df.drop(index=dropped).reset_index(drop=True)
+    return df, inserts, reindex or bool(dropped)
+
+# Function to apply the products other worker processes changed since the revision this process loaded. Only those rows
+# are read; new products and price changes are applied in place, and other changes rebuild the indexes. A write made here
+# meanwhile holds the catalog lock until it is in memory as well, so update_catalog builds the change again if it read one
+def reload_catalog(watcher):
+    catalog = watcher["catalog"]
+    
+    def build(current):
+        revision, products, deleted = read_product_changes(watcher["revisions"].get("catalog_revision", 0))
+        merged = merge_product_changes(current["df"], current["product_index"], products, deleted)
+        if merged is None or not merged[2]:
+            return revision, merged, None, None
+        return revision, merged, build_product_index(merged[0]), build_search_index(merged[0])
+    
+    def commit(change):
+        revision, merged, product_index, search_index = change
+        if merged is not None:
+            df, inserts, reindex = merged
+            if reindex:
+                catalog["product_index"] = product_index
+                catalog["search_index"] = search_index
+            else:
+                # Register the new rows in the product and search indexes, the way add_new_product does
+                for position, product in enumerate(inserts, start=len(catalog["df"])):
+                    catalog["product_index"][product["ID"]] = position
+                    add_to_search_index(catalog["search_index"], position, product["Part Number"], product["Product Name"], product["Description"], product["Barcode"])
+            catalog["df"] = df
+            catalog["version"] += 1
+        watcher["revisions"]["catalog_revision"] = revision
+    
+    update_catalog(catalog, build, commit)
+
+# Function to reload the price overrides of every branch this process has loaded; returns False when set_branch_price ran
+# here meanwhile, so what was read may lack that change and the next check tries again
+def reload_branch_prices(watcher):
+    loaded = watcher["revisions"].get("branch_prices_revision")
+    with closing(connect_db()) as conn:
+        revision = read_revision(conn, "branch_prices_revision")
+        rows = conn.execute("SELECT branch, product_id, price FROM branch_prices").fetchall()
+    prices = {}
+    for branch, product_id, price in rows:
+        prices.setdefault(branch, {})[product_id] = price
+    
+    catalog = watcher["catalog"]
+    with catalog["lock"]:
+        if watcher["revisions"].get("branch_prices_revision") != loaded:
+            return False
+        for branch, branch_prices in list(watcher["branch_prices"].items()):
+            if branch_prices["prices"] != prices.get(branch, {}):
+                branch_prices["prices"] = prices.get(branch, {})
+                branch_prices["version"] += 1
+        watcher["revisions"]["branch_prices_revision"] = revision
+    return True
+
+# Function to list history snapshots as (seq, timestamp, path), oldest first
+def list_snapshots():
+    snapshots = []
+    if os.path.isdir(HISTORY_DIR):
+        for name in os.listdir(HISTORY_DIR):
+            match = SNAPSHOT_NAME_PATTERN.match(name)
+            if match:
+                snapshots.append((int(match.group(1)), int(match.group(2)) / 1000, os.path.join(HISTORY_DIR, name)))
+    return sorted(snapshots)
+
+# Function to read the change log entries in order
+def read_changes():
+    changes = []
+    if os.path.exists(CHANGELOG_PATH):
+        with open(CHANGELOG_PATH, 'r', encoding='utf-8') as f:
+            for line in f:
+                # A crash mid-append can leave a torn last line; everything before it is intact
+                try:
+                    changes.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    return changes
+
+# Function to find the last change sequence number and start history with a baseline snapshot
+def init_history(catalog):
+    changes = read_changes()
+    snapshots = list_snapshots()
+    last_snapshot_seq = snapshots[-1][0] if snapshots else -1
+    catalog["change_seq"] = max([change["seq"] for change in changes[-1:]] + [last_snapshot_seq, 0])
+    catalog["changes_since_snapshot"] = catalog["change_seq"] - max(last_snapshot_seq, 0)
+    if not snapshots:
+        take_snapshot(catalog)
+
+# Function to append one change to the log, taking a snapshot every SNAPSHOT_INTERVAL changes (the caller holds the lock).
+# Worker processes share the log, so the database write lock orders their appends and a shared counter numbers them
+def log_change(catalog, change):
+    with write_transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('change_seq', 0)")
+        catalog["change_seq"] = conn.execute(
+            "UPDATE counters SET value = MAX(value, ?) + 1 WHERE name = 'change_seq' RETURNING value", (catalog["change_seq"],)
+        ).fetchall()[0][0]
+        change = {"seq": catalog["change_seq"], "ts": time.time(), **change}
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        with open(CHANGELOG_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(change, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    
+    catalog["changes_since_snapshot"] += 1
+    if catalog["changes_since_snapshot"] >= SNAPSHOT_INTERVAL:
+        take_snapshot(catalog)
+
+# Function to write a compacted snapshot of the catalog and garbage-collect old history (the caller holds the lock).
+# The snapshot is numbered with the shared change counter, since the catalog may hold changes other workers logged;
+# returns None without writing when the catalog is behind another worker's change, which the snapshot would drop
+def take_snapshot(catalog):
+    with write_transaction() as conn:
+        loaded = get_loaded_revisions().get("catalog_revision")
+        if loaded is not None and read_revision(conn, "catalog_revision") != loaded:
+            return None
+        seq = max(read_revision(conn, "change_seq"), catalog["change_seq"])
+        timestamp = time.time()
+        path = os.path.join(HISTORY_DIR, f"snapshot_{seq:012d}_{int(timestamp * 1000)}.json")
+        write_json_atomic(path, {"seq": seq, "ts": timestamp, "products": catalog_records(catalog["df"])})
+    catalog["change_seq"] = seq
+    catalog["changes_since_snapshot"] = 0
+    gc_history()
+    return path
+
+# Function to drop all but the newest SNAPSHOT_RETENTION snapshots and the changes older than the oldest one kept
+def gc_history():
+    snapshots = list_snapshots()
+    for _, _, path in snapshots[:-SNAPSHOT_RETENTION]:
+        os.remove(path)
+    oldest_seq = snapshots[-SNAPSHOT_RETENTION:][0][0]
+    # Hold the database write lock like log_change, so another worker cannot append while the log is rewritten
+    with write_transaction():
+        changes = read_changes()
+        if changes and changes[0]["seq"] <= oldest_seq:
+            kept = [change for change in changes if change["seq"] > oldest_seq]
+            # Rewrite the compacted log crash-safely, the same way carts are written
+            directory = os.path.dirname(CHANGELOG_PATH) or "."
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=".jsonl")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for change in kept:
+                    f.write(json.dumps(change, ensure_ascii=False, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, CHANGELOG_PATH)
+
+# Function to apply one logged change to a list of product records
+def apply_change(records, change):
+    op = change["op"]
+    if op == "add":
+        # A snapshot can already hold a product another worker added just before it was taken
+        product_id = change["product"].get("ID")
+        if product_id is None or not any(record.get("ID") == product_id for record in records):
+            records.append(change["product"])
+    elif op == "delete":
+        # Changes from before product IDs name the product by part number and name
+        if "id" in change:
+            records = [record for record in records if record.get("ID") != change["id"]]
+        else:
+            records = [
+                record for record in records
+                if not (catalog_text(record["Part Number"]) == change["part_number"] and record["Product Name"] == change["product_name"])
+            ]
+    elif op == "price":
+        # Bulk repricing logs every new price in one change as [product ID, price]; older entries carry
+        # [part number, product name, price], or a single product
+        prices_by_id = {}
+        prices = {}
+        for entry in change.get("prices", []):
+            if len(entry) == 2:
+                prices_by_id[entry[0]] = entry[1]
+            else:
+                prices[(entry[0], entry[1])] = entry[2]
+        if "part_number" in change:
+            prices[(change["part_number"], change["product_name"])] = change["price"]
+        for record in records:
+            price = prices_by_id.get(record.get("ID"))
+            if price is None:
+                price = prices.get((catalog_text(record["Part Number"]), record["Product Name"]))
+            if price is not None:
+                record["Price (EGP)"] = price
+    elif op == "upsert":
+        records = catalog_records(upsert_products(pd.DataFrame(records, columns=CATALOG_COLUMNS), change["products"]))
+    elif op == "replace":
+        records = list(change["products"])
+    return records
+
+# Function to rebuild the catalog as it was at a point in time, replaying changes from the nearest snapshot
+def catalog_at(timestamp):
+    snapshots = [snapshot for snapshot in list_snapshots() if snapshot[1] <= timestamp]
+    if not snapshots:
+        return None
+    seq, _, path = snapshots[-1]
+    with open(path, 'r', encoding='utf-8') as f:
+        records = json.load(f)["products"]
+    for change in read_changes():
+        if change["seq"] > seq and change["ts"] <= timestamp:
+            records = apply_change(records, change)
+    return normalize_catalog(pd.DataFrame(records, columns=CATALOG_COLUMNS))
+
+# Function to get the earliest time the catalog can be restored to
+def oldest_restore_point():
+    snapshots = list_snapshots()
+    return snapshots[0][1] if snapshots else None
+
+# Function to restore the catalog to a point in time, returns False if history does not go back that far
+def restore_catalog(timestamp):
+    df = catalog_at(timestamp)
+    if df is None:
         return False
+    catalog = get_shared_catalog()
+    with catalog["lock"]:
+        if not save_data(df):
+            return False
+        replace_catalog(catalog, df)
+        log_change(catalog, {"op": "replace", "products": catalog_records(df)})
+    sync_catalog()
+    calculate_cart_total()
+    return True
 
 # Function to calculate cart total
 def calculate_cart_total():
-    total = 0.0
-    for key, qty in st.session_state.quantities.items():
-        if qty > 0:
-            # Split the key back into part_number and product_name
-            part_number, product_name = key.split('_', 1)
-            
-            # Find the product in the DataFrame that matches both part number and product name
-            product_mask = (st.session_state.products_df['Part Number'] == part_number) & \
-                          (st.session_state.products_df['Product Name'] == product_name)
+    with span("calculate_cart_total"):
+        total = 0.0
+        for key, qty in st.session_state.quantities.items():
+            if qty > 0:
+                product_price = get_product_price(key)
+                if product_price is not None:
+                    total += product_price * qty
+        
+        st.session_state.cart_total = total
+
+# Function to keep the process-wide record of recent reruns, shared by every session
+@st.cache_resource
+def get_metrics_store():
+    return {"reruns": deque(maxlen=METRICS_HISTORY), "lock": threading.Lock()}
+
+# Function to close the metrics of this rerun: keep them for the admin panel and append them to the metrics file
+def finish_rerun_metrics(started, scope="app"):
+    metrics = st.session_state.pop('rerun_metrics', None) or {"spans": {}, "counters": {}}
+    record = {
+        "ts": time.time(),
+        "cart_id": st.session_state.cart_id,
+        "scope": scope,
+        "rerun_ms": round((time.perf_counter() - started) * 1000, 3),
+        "spans": {name: round(ms, 3) for name, ms in metrics["spans"].items()},
+        "counters": dict(metrics["counters"]),
+    }
+    st.session_state.last_rerun_metrics = record
+    store = get_metrics_store()
+    with store["lock"]:
+        store["reruns"].append(record)
+        try:
+            with open(METRICS_PATH, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError:
+            logging.exception("Error writing metrics")
+
+# Function to check the admin token given in the URL
+def is_admin():
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(st.query_params.get("admin", ""), ADMIN_TOKEN)
+
+# Function to render the admin-only instrumentation panel in the sidebar
+def render_metrics_panel():
+    with st.sidebar:
+        st.header("Performance")
+        if not METRICS_ENABLED:
+            st.info("Instrumentation is off. Start the app with INVENTORY_METRICS=1 to collect timings.")
+            return
+        import statistics
+        
+        last = st.session_state.get('last_rerun_metrics')
+        store = get_metrics_store()
+        with store["lock"]:
+            reruns = list(store["reruns"])
+        if last is not None:
+            st.metric("Last rerun", f"{last['rerun_ms']:.1f} ms")
             
-            if not product_mask.empty and any(product_mask):
-                product_price = st.session_state.products_df.loc[product_mask, 'Price (EGP)'].values[0]
-                total += product_price * qty
-    
-    st.session_state.cart_total = total
+            # Each stage of the last rerun next to its median over the recent reruns of all sessions
+            stages = sorted({name for record in reruns for name in record["spans"]} | set(last["spans"]))
+            st.dataframe(
+                pd.DataFrame({
+                    "Stage": stages,
+                    "Last (ms)": [last["spans"].get(name) for name in stages],
+                    "Median (ms)": [statistics.median(record["spans"][name] for record in reruns if name in record["spans"]) if any(name in record["spans"] for record in reruns) else None for name in stages],
+                }),
+                hide_index=True,
+            )
+            if last["counters"]:
+                st.dataframe(pd.DataFrame({"Counter": list(last["counters"]), "Last rerun": list(last["counters"].values())}), hide_index=True)
+        
+        writer = get_cart_writer()
+        with writer["lock"]:
+            st.caption(f"Cart writer: {writer['writes']} writes, {writer['bytes_written']} bytes")
+        for name, cache in get_render_caches().items():
+            with cache["lock"]:
+                st.caption(
+                    f"{name.capitalize()} cache: {len(cache['entries'])} entries, {cache['bytes'] // 1024} of {cache['max_bytes'] // 1024} KB,"
+                    f" {cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evictions"
+                )
+        st.caption(f"{len(reruns)} recent reruns; every rerun is appended to {METRICS_PATH}")
+        
+        st.checkbox("Profile reruns with cProfile", key="profile_reruns")
+        if st.session_state.get('last_profile'):
+            st.code(st.session_state.last_profile)
+
+# Start timing this rerun, with a cProfile capture when an admin asked for one
+script_running = True
+rerun_started = time.perf_counter()
+# A rerun cut short by st.rerun() never reaches the end of the script, so its profiler is stopped here; st.rerun()
+# restarts the script on the same thread, which is the one the profiler hooked
+unfinished_profiler = st.session_state.pop('profiler', None)
+if unfinished_profiler is not None:
+    unfinished_profiler.disable()
+profiler = None
+if METRICS_ENABLED and st.session_state.get('profile_reruns'):
+    import cProfile
+    profiler = cProfile.Profile()
+    st.session_state.profiler = profiler
+    profiler.enable()
 
-# Initialize session state for the product database if not already set
-if 'products_df' not in st.session_state:
-    st.session_state.products_df = load_data()
+# Give each session its own cart id, kept in the URL so a page reload finds the same cart; a cart another open tab
+# is using is left to it, so two sessions never write the same cart and reservations
+if 'cart_id' not in st.session_state:
+    cart_id = st.query_params.get("cart")
+    if not cart_id or not CART_ID_PATTERN.match(cart_id) or not claim_cart(cart_id):
+        cart_id = uuid.uuid4().hex[:12]
+        claim_cart(cart_id)
+    st.session_state.cart_id = cart_id
+    st.query_params["cart"] = cart_id
+
+# Each session works for one branch, kept in the URL so a shop's tills always open their own branch
+if 'branch' not in st.session_state:
+    branches = get_branches()
+    branch = st.query_params.get("branch", DEFAULT_BRANCH)
+    if branch not in branches:
+        branch = DEFAULT_BRANCH
+    st.session_state.branch = branch
+    st.session_state.branch_name = branches.get(branch, branch)
+    st.query_params["branch"] = branch
 
 # Initialize session state for quantities if not already set
 if 'quantities' not in st.session_state:
-    st.session_state.quantities = load_cart()
-    
-if 'cart_total' not in st.session_state:
-    st.session_state.cart_total = 0.0
+    st.session_state.quantities = load_cart(st.session_state.cart_id)
+
+# Point the session at the shared catalog, repricing the cart when another session changed it
+if sync_catalog() or 'cart_total' not in st.session_state:
     calculate_cart_total()
 
 # Initialize form input variables with proper types
@@ -229,27 +1727,228 @@ if 'new_price' not in st.session_state:
     st.session_state.new_price = 0.0
 if 'new_barcode' not in st.session_state:
     st.session_state.new_barcode = ""
+if 'new_stock' not in st.session_state:
+    st.session_state.new_stock = None
 if 'show_success' not in st.session_state:
     st.session_state.show_success = False
 if 'show_delete_confirm' not in st.session_state:
     st.session_state.show_delete_confirm = False
-if 'delete_product_key' not in st.session_state:
-    st.session_state.delete_product_key = None
+if 'delete_product_id' not in st.session_state:
+    st.session_state.delete_product_id = None
 if 'delete_success' not in st.session_state:
     st.session_state.delete_success = False
 
-# Function to update quantity
-def update_quantity(part_number, product_name, change):
-    key = f"{part_number}_{product_name}"  # Use combined key for products with duplicate part numbers
-    current_qty = st.session_state.quantities[key]
+# Initialize the barcode scan queue
+if 'scan_queue' not in st.session_state:
+    st.session_state.scan_queue = deque()
+if 'scan_messages' not in st.session_state:
+    st.session_state.scan_messages = []
+
+# Initialize pagination cursors and page sizes
+if 'catalog_page' not in st.session_state:
+    st.session_state.catalog_page = 0
+if 'catalog_page_size' not in st.session_state:
+    st.session_state.catalog_page_size = DEFAULT_PAGE_SIZE
+if 'catalog_search' not in st.session_state:
+    st.session_state.catalog_search = ("", "")
+if 'inventory_page' not in st.session_state:
+    st.session_state.inventory_page = 0
+if 'inventory_page_size' not in st.session_state:
+    st.session_state.inventory_page_size = DEFAULT_PAGE_SIZE
+
+# Function to move a paginated list to another page
+def change_page(cursor_key, change):
+    st.session_state[cursor_key] = max(0, st.session_state[cursor_key] + change)
+
+# Function to render pagination controls for a list of total rows, returns the visible (page, page size)
+def page_controls(total, cursor_key, page_size_key):
+    page_size = st.session_state[page_size_key]
+    total_pages = max(1, -(-total // page_size))
+    
+    # Clamp the cursor in case the list shrank or the page size grew
+    page = min(st.session_state[cursor_key], total_pages - 1)
+    st.session_state[cursor_key] = page
+    
+    col1, col2, col3, col4 = st.columns([1, 2, 1, 1])
+    with col1:
+        st.button("⬅️ Previous", key=f"prev_{cursor_key}", on_click=change_page, args=(cursor_key, -1), disabled=page == 0)
+    with col2:
+        st.markdown(f"<div style='text-align: center;'>Page {page + 1} of {total_pages} ({total} products)</div>", unsafe_allow_html=True)
+    with col3:
+        st.button("Next ➡️", key=f"next_{cursor_key}", on_click=change_page, args=(cursor_key, 1), disabled=page >= total_pages - 1)
+    with col4:
+        st.selectbox("Products per page", PAGE_SIZE_OPTIONS, key=page_size_key)
+    return page, page_size
+
+# Function to render pagination controls and return the visible slice of a DataFrame
+def paginate(df, cursor_key, page_size_key):
+    page, page_size = page_controls(len(df), cursor_key, page_size_key)
+    start = page * page_size
+    return df.iloc[start:start + page_size]
+
+# Function to create the process-wide LRU caches shared by every session: search result pages and product card HTML
+@st.cache_resource
+def get_render_caches():
+    return {
+        name: {"entries": OrderedDict(), "bytes": 0, "max_bytes": max_bytes, "hits": 0, "misses": 0, "evictions": 0, "lock": threading.Lock()}
+        for name, max_bytes in (("search", SEARCH_CACHE_BYTES), ("card", CARD_CACHE_BYTES))
+    }
+
+# Function to look up an LRU cache entry and count the hit or miss, returns None on a miss
+def cache_get(caches, name, key):
+    cache = caches[name]
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is None:
+            cache["misses"] += 1
+        else:
+            cache["entries"].move_to_end(key)
+            cache["hits"] += 1
+    count(f"{name}_cache_misses" if entry is None else f"{name}_cache_hits")
+    return None if entry is None else entry[0]
+
+# Function to add an LRU cache entry of about size bytes, evicting the least recently used entries over the cache's budget
+def cache_put(caches, name, key, value, size):
+    cache = caches[name]
+    with cache["lock"]:
+        old = cache["entries"].pop(key, None)
+        if old is not None:
+            cache["bytes"] -= old[1]
+        cache["entries"][key] = (value, size)
+        cache["bytes"] += size
+        while cache["bytes"] > cache["max_bytes"] and len(cache["entries"]) > 1:
+            _, (_, evicted) = cache["entries"].popitem(last=False)
+            cache["bytes"] -= evicted
+            cache["evictions"] += 1
+
+# Function to get one page of search results as catalog row positions, returns (positions, total matches).
+# Pages are cached per catalog version, so paging back and forth or repeating a search does not search again
+def search_page(query, search_type, page, page_size):
+    caches = get_render_caches()
+    key = (st.session_state.catalog_version[0], query, search_type, page, page_size)
+    cached = cache_get(caches, "search", key)
+    if cached is None:
+        # Skip rows another session appended to the shared index after this session's snapshot
+        rows = len(st.session_state.products_df)
+        positions = [position for position in search_catalog(st.session_state.search_index, query, search_type) if position < rows]
+        cached = (positions[page * page_size:(page + 1) * page_size], len(positions))
+        cache_put(caches, "search", key, cached, sys.getsizeof(cached[0]) + 8 * len(cached[0]) + sys.getsizeof(query))
+    return cached
+
+# Function to get the HTML of a product card (part number, price, country, barcode, name), cached per product and
+# catalog version as this session's branch sees it, so a price, name or branch price change renders it again
+def card_html(row, product_id):
+    caches = get_render_caches()
+    key = (product_id, st.session_state.branch, st.session_state.catalog_version)
+    pieces = cache_get(caches, "card", key)
+    if pieces is None:
+        part_number = row['Part Number'] if not pd.isna(row['Part Number']) else ""
+        pieces = (
+            f"<div><strong>{part_number}</strong></div>",
+            f"<div class='product-price'>Price: {row['Price (EGP)']:.2f} EGP</div>",
+            f"<div>Country: {row['Country']}</div>",
+            f"<div class='barcode'>Barcode: {catalog_text(row['Barcode'])}</div>",
+            f"<div class='product-name'>{row['Product Name']}</div>",
+        )
+        cache_put(caches, "card", key, pieces, sum(sys.getsizeof(piece) for piece in pieces))
+    return pieces
+
+# Function to update quantity, returns False when there is not enough stock for an increment and leaves the reason in
+# stock_message for the page to show; it runs as a widget callback, which must not draw anything itself
+def update_quantity(product_id, change):
+    product = get_product(product_id)
+    # Another session deleted the product since this page was drawn
+    if product is None:
+        return False
+    product_name = product['Product Name']
+    current_qty = st.session_state.quantities[product_id]
     new_qty = max(0, current_qty + change)  # Ensure quantity doesn't go below 0
-    st.session_state.quantities[key] = new_qty
     
-    # Recalculate cart total
-    calculate_cart_total()
+    # Hold the stock for this cart first; only increments can be refused
+    reserved, available = reserve_stock(st.session_state.branch, st.session_state.cart_id, product_id, new_qty, enforce=change > 0)
+    if not reserved:
+        st.session_state.stock_message = f"Only {max(0, available)} × {product_name} in stock"
+        return False
+    st.session_state.quantities[product_id] = new_qty
+    
+    # Update cart total from the quantity delta
+    st.session_state.cart_total = round(st.session_state.cart_total + float(product['Price (EGP)']) * (new_qty - current_qty), 2)
+    
+    # Queue the cart save; the cart writer coalesces rapid clicks into one write
+    schedule_cart_save(st.session_state.cart_id, st.session_state.quantities)
+    return True
+
+# Function to check the check digit of an EAN-13 barcode
+def is_valid_ean13(code):
+    if len(code) != 13 or not code.isdigit():
+        return False
+    total = sum(int(digit) * (3 if i % 2 else 1) for i, digit in enumerate(code[:12]))
+    return (10 - total % 10) % 10 == int(code[12])
+
+# Function to resolve a scanned barcode to (product ID, product name) through the barcode hash index
+def find_product_by_barcode(barcode):
+    barcode = barcode_key(barcode)
+    df = st.session_state.products_df
+    for position in st.session_state.search_index["barcode_exact"].get(barcode, ()):
+        # Skip rows another session appended to the shared index after this session's snapshot
+        if position < len(df):
+            return int(df['ID'].iat[position]), df['Product Name'].iat[position]
+    return None
+
+# Function to queue the codes typed or scanned into the scan box and apply them
+def handle_scan():
+    cart_was_empty = sum(st.session_state.quantities.values()) == 0
+    codes = SCAN_SPLIT_PATTERN.split(st.session_state.scan_input.translate(ARABIC_LETTER_FOLDING))
+    st.session_state.scan_input = ""
+    st.session_state.scan_queue.extend(code for code in codes if code)
+    process_scan_queue()
+    # The scan box reruns on its own; the first item also needs the order actions, which only a full run draws
+    filled_cart = cart_was_empty and sum(st.session_state.quantities.values()) > 0
+    st.session_state.scan_redraw = "app" if filled_cart else "cart"
+
+# Function to apply queued scans in order, one cart increment per scan
+def process_scan_queue():
+    messages = []
+    while st.session_state.scan_queue:
+        code = st.session_state.scan_queue.popleft()
+        if len(code) == 13 and not is_valid_ean13(code):
+            messages.append(("error", f"{code}: invalid EAN-13 check digit"))
+            continue
+        product = find_product_by_barcode(code)
+        if product is None:
+            messages.append(("error", f"{code}: no product with this barcode"))
+            continue
+        product_id, product_name = product
+        if not update_quantity(product_id, 1):
+            # The scan box shows the refusal with the other scan results
+            message = st.session_state.pop('stock_message', f"{product_name} is no longer in the catalog")
+            messages.append(("error", f"{code}: {message}"))
+            continue
+        messages.append(("success", f"{product_name} × {st.session_state.quantities[product_id]}"))
+    st.session_state.scan_messages = messages
+
+# Function to render the barcode scan box. A scan reruns only this fragment, not the catalog page;
+# it then redraws the two things a scan changes outside it, the header cart total and the order summary lines
+@st.fragment
+def render_scanner(summary_lines):
+    fragment_started = time.perf_counter()
+    redraw = st.session_state.pop('scan_redraw', None)
+    if redraw == "app":
+        st.rerun()
+    
+    st.text_input("Scan barcode", key="scan_input", on_change=handle_scan, placeholder="Scan or type a barcode and press Enter")
+    for level, message in st.session_state.scan_messages:
+        if level == "error":
+            st.error(message)
+        else:
+            st.success(message)
     
-    # Save cart data to file
-    save_cart(st.session_state.quantities)
+    # Inside a catalog run the view draws these itself
+    if redraw == "cart":
+        render_cart_lines(summary_lines)
+        header_total.markdown(f"<h2 style='text-align: center; color: #ff9900;'>Cart Total: {st.session_state.cart_total:.2f} EGP</h2>", unsafe_allow_html=True)
+        if METRICS_ENABLED and not script_running:
+            finish_rerun_metrics(fragment_started, scope="scanner")
 
 # Function to add a new product
 def add_new_product():
@@ -260,15 +1959,7 @@ def add_new_product():
     new_country = st.session_state.new_country
     new_price = st.session_state.new_price
     new_barcode = st.session_state.new_barcode
-    
-    # Validate input
-    if not new_product_name:
-        st.error("Product Name is required")
-        return
-    
-    if new_price <= 0:
-        st.error("Price must be greater than 0")
-        return
+    new_stock = st.session_state.new_stock
     
     # Create new product dictionary
     new_product = {
@@ -280,11 +1971,41 @@ def add_new_product():
         "Barcode": new_barcode
     }
     
-    # Add the new product to the DataFrame
-    st.session_state.products_df = pd.concat([st.session_state.products_df, pd.DataFrame([new_product])], ignore_index=True)
+    # Validate input
+    error = validate_product(new_product)
+    if error:
+        st.error(error)
+        return
+    
+    # Barcodes are stored as integers
+    new_product["Barcode"] = int(new_barcode) if new_barcode.strip() else None
     
-    # Save data to file
-    save_data(st.session_state.products_df)
+    catalog = get_shared_catalog()
+    with catalog["lock"]:
+        highest = int(catalog["df"]["ID"].max()) if len(catalog["df"]) else 0
+    new_product["ID"] = next_product_ids(1, highest)
+    
+    def build(current):
+        return normalize_catalog(pd.concat([current["df"], pd.DataFrame([new_product])], ignore_index=True))
+    
+    def commit(df):
+        # Register the new row in the product and search indexes
+        new_position = len(df) - 1
+        catalog["product_index"][new_product["ID"]] = new_position
+        add_to_search_index(catalog["search_index"], new_position, new_part_number, new_product_name, new_description, new_product["Barcode"])
+        catalog["df"] = df
+        catalog["version"] += 1
+        
+        # Save the new product
+        insert_product(new_product, df)
+        log_change(catalog, {"op": "add", "product": new_product})
+    
+    update_catalog(catalog, build, commit)
+    sync_catalog()
+    
+    # An empty opening stock leaves the product untracked
+    if new_stock is not None:
+        set_stock(st.session_state.branch, new_product["ID"], int(new_stock))
     
     # Clear the form inputs
     st.session_state.new_part_number = ""
@@ -293,41 +2014,60 @@ def add_new_product():
     st.session_state.new_country = ""
     st.session_state.new_price = 0.0
     st.session_state.new_barcode = ""
+    st.session_state.new_stock = None
     
     # Show success message
     st.session_state.show_success = True
 
 # Function to show delete confirmation
-def show_delete_confirmation(key):
+def show_delete_confirmation(product_id):
     st.session_state.show_delete_confirm = True
-    st.session_state.delete_product_key = key
+    st.session_state.delete_product_id = product_id
 
 # Function to cancel deletion
 def cancel_delete():
     st.session_state.show_delete_confirm = False
-    st.session_state.delete_product_key = None
+    st.session_state.delete_product_id = None
 
 # Function to delete product
 def delete_product():
-    key = st.session_state.delete_product_key
-    if key:
-        part_number, product_name = key.split('_', 1)
+    product_id = st.session_state.delete_product_id
+    if product_id is not None:
+        catalog = get_shared_catalog()
         
-        # Find the product index
-        product_mask = (st.session_state.products_df['Part Number'] == part_number) & \
-                      (st.session_state.products_df['Product Name'] == product_name)
+        # Row positions shift, so the indexes are rebuilt
+        def build(current):
+            # Find the product's row
+            position = current["product_index"].get(product_id)
+            if position is None:
+                return None
+            df = current["df"]
+            part_number = catalog_text(df['Part Number'].iat[position])
+            product_name = df['Product Name'].iat[position]
+            df = df.drop(index=position).reset_index(drop=True)
+            return df, build_product_index(df), build_search_index(df), part_number, product_name
         
-        if any(product_mask):
-            # Drop the product from the DataFrame
-            st.session_state.products_df = st.session_state.products_df[~product_mask].reset_index(drop=True)
+        def commit(change):
+            df, product_index, search_index, part_number, product_name = change
+            catalog["df"] = df
+            catalog["product_index"] = product_index
+            catalog["search_index"] = search_index
+            catalog["version"] += 1
             
-            # Save data to file
-            save_data(st.session_state.products_df)
+            # Remove the product from storage
+            delete_product_rows(product_id, df)
+            log_change(catalog, {"op": "delete", "id": product_id, "part_number": part_number, "product_name": product_name})
+            return True
+        
+        deleted = update_catalog(catalog, build, commit)
+        if deleted:
+            delete_stock(product_id)
+            sync_catalog()
             
             # Remove from cart if present
-            if key in st.session_state.quantities:
-                del st.session_state.quantities[key]
-                save_cart(st.session_state.quantities)
+            if product_id in st.session_state.quantities:
+                del st.session_state.quantities[product_id]
+                schedule_cart_save(st.session_state.cart_id, st.session_state.quantities)
                 calculate_cart_total()
             
             # Set success flag
@@ -335,20 +2075,1007 @@ def delete_product():
     
     # Reset confirmation state
     st.session_state.show_delete_confirm = False
-    st.session_state.delete_product_key = None
+    st.session_state.delete_product_id = None
 
-# App header with styled title
-st.markdown("<h1 style='text-align: center; color: #4CAF50;'>Product Inventory Management</h1>", unsafe_allow_html=True)
-st.markdown(f"<h3 style='text-align: center;'>Total Products: {len(st.session_state.products_df)}</h3>", unsafe_allow_html=True)
+# Function to save the stock on hand entered in the inventory list
+def update_stock(product_id, widget_key):
+    on_hand = st.session_state[widget_key]
+    set_stock(st.session_state.branch, product_id, int(on_hand) if on_hand is not None else None)
 
-# Display cart total with styling
-st.markdown(f"<h2 style='text-align: center; color: #ff9900;'>Cart Total: {st.session_state.cart_total:.2f} EGP</h2>", unsafe_allow_html=True)
+# Function to save the branch price entered in the inventory list and reprice the cart
+def update_branch_price(product_id, widget_key):
+    set_branch_price(st.session_state.branch, product_id, st.session_state[widget_key])
+    sync_catalog()
+    calculate_cart_total()
 
-# Create tabs for different sections
-tabs = st.tabs(["Product Catalog", "Add New Product", "Manage Inventory"])
+# Function to check a product against the catalog rules, returns an error message or None.
+# Only the columns the product carries are checked; new_product_error checks a new one has the rest
+def validate_product(product):
+    if "Product Name" in product and not product["Product Name"]:
+        return "Product Name is required"
+    if "Price (EGP)" in product and product["Price (EGP)"] <= 0:
+        return "Price must be greater than 0"
+    if catalog_text(product.get("Barcode")).strip() and not catalog_text(product.get("Barcode")).strip().isdigit():
+        return "Barcode must contain digits only"
+    return None
 
-# Product Catalog Tab
-with tabs[0]:
+# Function to check that a product new to the catalog has the columns every product needs, returns an error message or None
+def new_product_error(product):
+    if not product.get("Product Name"):
+        return "Product Name is required"
+    if "Price (EGP)" not in product:
+        return "Price is required"
+    return None
+
+# Function to stream product records from an uploaded CSV/XLSX/JSON file in chunks
+def iter_import_chunks(uploaded_file):
+    name = uploaded_file.name.lower()
+    if name.endswith(".csv"):
+        # Read every column as text so leading zeros in part numbers survive
+        for chunk in pd.read_csv(uploaded_file, dtype=str, keep_default_na=False, encoding='utf-8-sig', chunksize=IMPORT_CHUNK_SIZE):
+            yield chunk.to_dict('records')
+    elif name.endswith(".jsonl"):
+        for chunk in pd.read_json(uploaded_file, lines=True, dtype=False, chunksize=IMPORT_CHUNK_SIZE):
+            yield chunk.to_dict('records')
+    elif name.endswith(".json"):
+        # A JSON array has to be parsed as a whole; validation still runs chunk by chunk
+        data = json.load(uploaded_file)
+        for start in range(0, len(data), IMPORT_CHUNK_SIZE):
+            yield data[start:start + IMPORT_CHUNK_SIZE]
+    elif name.endswith(".xlsx"):
+        if importlib.util.find_spec("openpyxl") is None:
+            raise ImportError("Importing .xlsx files requires the openpyxl package")
+        import openpyxl
+        workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(value).strip() if value is not None else "" for value in next(rows, ())]
+        chunk = []
+        for values in rows:
+            chunk.append(dict(zip(header, values)))
+            if len(chunk) == IMPORT_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        workbook.close()
+    else:
+        raise ValueError(f"Unsupported file type: {uploaded_file.name}")
+
+# Function to turn an imported record into a product dictionary, returns (product, error).
+# Only the columns the file has are kept, so a product it updates keeps the others
+def normalize_import_record(record):
+    product = {}
+    for column in PRODUCT_COLUMNS:
+        if column in record:
+            value = record[column]
+            product[column] = catalog_text(value).strip() if column != "Price (EGP)" else value
+    
+    if "Price (EGP)" in product:
+        try:
+            product["Price (EGP)"] = float(product["Price (EGP)"])
+        except (TypeError, ValueError):
+            return None, "Price must be a number"
+        if pd.isna(product["Price (EGP)"]):
+            return None, "Price must be a number"
+    
+    error = validate_product(product)
+    if error:
+        return None, error
+    return product, None
+
+# Function to match products to catalog rows on barcode first and then part number, the one rule imports and price list
+# syncs share; returns a row position per product. Products matching no row are numbered on from len(df) in order, and
+# later products of the same list match them as well
+def match_products(df, products):
+    by_barcode = {}
+    by_part_number = {}
+    for position, (part_number, barcode) in enumerate(zip(df['Part Number'].tolist(), df['Barcode'].tolist())):
+        by_barcode.setdefault(barcode_key(barcode), position)
+        by_part_number.setdefault(catalog_text(part_number), position)
+    by_barcode.pop("", None)
+    by_part_number.pop("", None)
+    
+    positions = []
+    added = len(df)
+    for product in products:
+        barcode = barcode_key(product.get("Barcode"))
+        part_number = product.get("Part Number", "")
+        position = by_barcode.get(barcode) if barcode else None
+        if position is None and part_number:
+            position = by_part_number.get(part_number)
+        if position is None:
+            position = added
+            added += 1
+        positions.append(position)
+        
+        if barcode:
+            by_barcode.setdefault(barcode, position)
+        if part_number:
+            by_part_number.setdefault(part_number, position)
+    return positions
+
+# Function to merge logged upsert products into a catalog when the change log is replayed, matching them with
+# match_products the way apply_price_list did; new products carry the IDs they were given then
+def upsert_products(df, products):
+    records = df.to_dict('records')
+    for product, position in zip(products, match_products(df, products)):
+        if position == len(records):
+            records.append(product)
+        else:
+            # Only the columns the product carries change; an updated product keeps its ID
+            records[position] = {**records[position], **product, "ID": records[position].get("ID")}
+    return normalize_catalog(pd.DataFrame(records, columns=CATALOG_COLUMNS))
+
+# Function to read and validate the products of a price list file against the catalog df, returns (products, rejects).
+# A row for a product already in the catalog may carry any columns; a row that adds one needs a name and a price
+def read_price_list(price_list, df):
+    products = []
+    rows = []
+    rejects = []
+    row_number = 0
+    for chunk in iter_import_chunks(price_list):
+        for record in chunk:
+            row_number += 1
+            product, error = normalize_import_record(record)
+            if error:
+                rejects.append({"Row": row_number, "Product Name": catalog_text(record.get("Product Name")), "Reason": error})
+            else:
+                products.append(product)
+                rows.append(row_number)
+    
+    # The first accepted row for a new product is the one that adds it; later rows for it only update it
+    added = set()
+    accepted = []
+    for product, row_number, position in zip(products, rows, match_products(df, products)):
+        if position >= len(df) and position not in added:
+            error = new_product_error(product)
+            if error:
+                rejects.append({"Row": row_number, "Product Name": product.get("Product Name", ""), "Reason": error})
+                continue
+            added.add(position)
+        accepted.append(product)
+    rejects.sort(key=lambda reject: reject["Row"])
+    return accepted, rejects
+
+# Function to import products from an uploaded file, returns (inserted, updated, rejects). An import is applied like a
+# synced price list, so only the rows that change are written
+def import_products(uploaded_file):
+    catalog = get_shared_catalog()
+    products, rejects = read_price_list(uploaded_file, catalog["df"])
+    updated, inserted = apply_price_list(catalog, products)
+    sync_catalog()
+    calculate_cart_total()
+    return inserted, updated, rejects
+
+# Function to diff a price list against the catalog, matching it with match_products like upsert_products;
+# returns ({position: product} for rows that change, new products, whether any indexed column changes)
+def diff_price_list(df, products):
+    columns = {column: df[column].tolist() for column in PRODUCT_COLUMNS}
+    updates = {}
+    inserts = []
+    reindex = False
+    for product, position in zip(products, match_products(df, products)):
+        if position == len(df) + len(inserts):
+            inserts.append(product)
+            reindex = True
+        elif position >= len(df):
+            # A later row of the same list for a product it adds
+            inserts[position - len(df)] = {**inserts[position - len(df)], **product}
+        else:
+            # Later rows for the same product build on the earlier ones, the way upsert_products applies them
+            product = {**updates.get(position, {}), **product}
+            changed = [
+                column for column in PRODUCT_COLUMNS if column in product
+                and (round(float(columns[column][position]), 2) != round(product[column], 2) if column == "Price (EGP)"
+                     else barcode_key(columns[column][position]) != barcode_key(product[column]) if column == "Barcode"
+                     else catalog_text(columns[column][position]) != product[column])
+            ]
+            if changed:
+                updates[position] = product
+                reindex = reindex or any(column in INDEXED_COLUMNS for column in changed)
+            else:
+                updates.pop(position, None)
+    
+    return updates, inserts, reindex
+
+# Function to build the catalog with a price list diff applied; unchanged rows keep their positions, and updated rows their
+# IDs and the columns the list does not have. New products carry the IDs they were given, so replaying the change log
+# gives them the same ones
+def merge_price_list(df, updates, inserts):
+    df = df.reset_index(drop=True)
+    original_count = len(df)
+    records = catalog_records(df.iloc[list(updates)])
+    changed = pd.DataFrame(
+        [{**record, **product, "ID": record["ID"]} for record, product in zip(records, updates.values())] + inserts,
+        columns=CATALOG_COLUMNS,
+        index=list(updates) + list(range(original_count, original_count + len(inserts))),
+    )
+    df = normalize_catalog(pd.concat([df.drop(index=list(updates)), changed]).sort_index().reset_index(drop=True))
+    for product, product_id in zip(inserts, df['ID'].iloc[original_count:].tolist()):
+        product["ID"] = product_id
+    return df
+
+# Function to turn a price list diff into table rows: (updates ending with their ID, inserts)
+def price_list_rows(old_df, df, updates):
+    positions = list(updates)
+    update_rows = [(*product_to_row(product), product["ID"]) for product in catalog_records(df.iloc[positions])]
+    insert_rows = [(product["ID"], *product_to_row(product)) for product in catalog_records(df.iloc[len(old_df):])]
+    return update_rows, insert_rows
+
+# Function to write a price list diff in one transaction: the changed and new products (the caller holds the catalog lock).
+# Stock, reservations and branch prices are kept per product ID, so a renamed product keeps them
+def persist_price_list(df, update_rows, insert_rows):
+    if STORAGE_BACKEND != "sqlite":
+        write_json_atomic(DATA_PATH, catalog_records(df))
+        return
+    with write_transaction() as conn:
+        conn.executemany(
+            "UPDATE products SET part_number = ?, product_name = ?, description = ?, country = ?, price = ?, barcode = ?"
+            " WHERE id = ?",
+            update_rows,
+        )
+        conn.executemany(
+            "INSERT INTO products (id, part_number, product_name, description, country, price, barcode) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            insert_rows,
+        )
+        bump_revision(conn, "catalog_revision")
+
+# Function to apply a price list to the shared catalog, returns (updated, inserted). The diff, the merged catalog, its rows
+# and any index rebuild are computed by update_catalog without the catalog lock
+def apply_price_list(catalog, products):
+    def build(current):
+        df = current["df"]
+        updates, inserts, reindex = diff_price_list(df, products)
+        if not updates and not inserts:
+            return None
+        new_df = merge_price_list(df, updates, inserts)
+        # Updated rows keep their IDs and positions, so only new products change the product index
+        product_index = build_product_index(new_df) if inserts else current["product_index"]
+        search_index = build_search_index(new_df) if reindex else current["search_index"]
+        return updates, inserts, new_df, price_list_rows(df, new_df, updates), product_index, search_index
+    
+    def commit(change):
+        updates, inserts, new_df, rows, product_index, search_index = change
+        persist_price_list(new_df, *rows)
+        catalog["df"] = new_df
+        catalog["product_index"] = product_index
+        catalog["search_index"] = search_index
+        catalog["version"] += 1
+        log_change(catalog, {"op": "upsert", "products": list(updates.values()) + inserts})
+        return len(updates), len(inserts)
+    
+    return update_catalog(catalog, build, commit) or (0, 0)
+
+# Function to round a Series of prices by one of PRICE_ROUNDING_RULES; a price the rule would take to zero or below
+# keeps its unrounded value
+def round_prices(prices, rule):
+    rounded = prices
+    if rule == "Nearest 0.05":
+        rounded = (prices * 20).round() / 20
+    elif rule == "Nearest pound":
+        rounded = prices.round()
+    elif rule == "End in .99":
+        rounded = prices.round() - 0.01
+    elif rule == "End in 9":
+        rounded = ((prices + 1) / 10).round() * 10 - 1
+    elif rule == "End in 99":
+        rounded = ((prices + 1) / 100).round() * 100 - 1
+    return rounded.where(rounded > 0, prices).round(2)
+
+# Function to reprice the products matching the filters by a factor, vectorized over the whole catalog;
+# returns the row positions whose price changes and their new prices
+def reprice_catalog(df, countries, part_number_prefix, factor, rounding):
+    prices = df['Price (EGP)']
+    selected = pd.Series(True, index=df.index)
+    if countries:
+        selected &= df['Country'].isin(countries)
+    if part_number_prefix:
+        selected &= df['Part Number'].fillna("").str.startswith(part_number_prefix)
+    new_prices = round_prices(prices * factor, rounding)
+    changed = (selected & (new_prices > 0) & (new_prices != prices)).to_numpy(dtype=bool, na_value=False)
+    positions = changed.nonzero()[0]
+    return positions, new_prices.to_numpy()[positions]
+
+# Function to show the first rows of a repricing as a diff table
+def reprice_preview(df, positions, new_prices):
+    positions, new_prices = positions[:REPRICE_PREVIEW_ROWS], new_prices[:REPRICE_PREVIEW_ROWS]
+    rows = df.iloc[positions]
+    old_prices = rows['Price (EGP)'].to_numpy()
+    return pd.DataFrame({
+        "Part Number": rows['Part Number'].to_numpy(),
+        "Product Name": rows['Product Name'].to_numpy(),
+        "Country": rows['Country'].to_numpy(),
+        "Old Price": old_prices,
+        "New Price": new_prices,
+        "Change %": ((new_prices / old_prices - 1) * 100).round(1),
+    })
+
+# Function to write new prices in one transaction; rows are (price, product ID) (the caller holds the catalog lock)
+def persist_prices(df, rows):
+    if STORAGE_BACKEND != "sqlite":
+        write_json_atomic(DATA_PATH, catalog_records(df))
+        return
+    with write_transaction() as conn:
+        # One joined UPDATE from a temporary table instead of a lookup per changed product
+        conn.execute("CREATE TEMP TABLE new_prices (price REAL, id INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT INTO new_prices VALUES (?, ?)", rows)
+        conn.execute("UPDATE products SET price = new_prices.price FROM new_prices WHERE products.id = new_prices.id")
+        conn.execute("DROP TABLE new_prices")
+        bump_revision(conn, "catalog_revision")
+
+# Function to apply a repricing computed against a catalog version, returns False when the catalog has changed since.
+# Prices are not indexed, so the product and search indexes carry over as they are
+def apply_repricing(catalog, version, positions, new_prices):
+    def build(current):
+        df = current["df"]
+        prices = df['Price (EGP)'].to_numpy(copy=True)
+        prices[positions] = new_prices
+        return df.assign(**{'Price (EGP)': prices}), df['ID'].iloc[positions].tolist(), new_prices.tolist()
+    
+    def commit(change):
+        new_df, ids, prices = change
+        persist_prices(new_df, list(zip(prices, ids)))
+        catalog["df"] = new_df
+        catalog["version"] += 1
+        log_change(catalog, {"op": "price", "prices": [list(price) for price in zip(ids, prices)]})
+        return True
+    
+    return update_catalog(catalog, build, commit, version) is not None
+
+# Function to start the price-list sync worker once per server process
+@st.cache_resource
+def get_price_sync_worker():
+    worker = {"catalog": get_shared_catalog(), "events": deque(maxlen=PRICE_SYNC_HISTORY), "lock": threading.Lock(), "url_digest": None}
+    if PRICE_SYNC_ENABLED:
+        threading.Thread(target=run_price_sync, args=(worker,), daemon=True, name="price-sync").start()
+    return worker
+
+# Function run by the price-list sync thread
+def run_price_sync(worker):
+    while True:
+        time.sleep(PRICE_SYNC_INTERVAL)
+        try:
+            sync_price_drop(worker)
+            if PRICE_SYNC_URL:
+                sync_price_url(worker)
+        except Exception:
+            logging.exception("Error syncing price lists")
+
+# Function to sync every price list waiting in the drop folder, oldest name first, then move it to processed/ or failed/
+def sync_price_drop(worker):
+    if not os.path.isdir(PRICE_DROP_DIR):
+        return
+    for name in sorted(os.listdir(PRICE_DROP_DIR)):
+        path = os.path.join(PRICE_DROP_DIR, name)
+        # Hidden files and files modified in the last second may still be being copied in
+        if name.startswith(".") or not name.lower().endswith(PRICE_LIST_SUFFIXES) or not os.path.isfile(path) or time.time() - os.path.getmtime(path) < 1:
+            continue
+        with open(path, 'rb') as f:
+            event = sync_price_list(worker, f, name)
+        done_dir = os.path.join(PRICE_DROP_DIR, "failed" if event["Error"] else "processed")
+        os.makedirs(done_dir, exist_ok=True)
+        os.replace(path, os.path.join(done_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{name}"))
+
+# Function to sync the price list served at PRICE_SYNC_URL when its content changed since the last poll
+def sync_price_url(worker):
+    with urllib.request.urlopen(PRICE_SYNC_URL, timeout=30) as response:
+        payload = response.read()
+    digest = hashlib.sha256(payload).hexdigest()
+    if digest == worker["url_digest"]:
+        return
+    # A failed list is not retried until its content changes
+    worker["url_digest"] = digest
+    price_list = io.BytesIO(payload)
+    price_list.name = urllib.parse.urlparse(PRICE_SYNC_URL).path
+    sync_price_list(worker, price_list, PRICE_SYNC_URL)
+
+# Function to read and apply one price list, recording the outcome in the worker's recent events
+def sync_price_list(worker, price_list, source):
+    event = {"Time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Source": source, "Updated": 0, "Added": 0, "Rejected": 0, "Error": ""}
+    try:
+        products, rejects = read_price_list(price_list, worker["catalog"]["df"])
+        event["Rejected"] = len(rejects)
+        event["Updated"], event["Added"] = apply_price_list(worker["catalog"], products)
+    except Exception as e:
+        logging.exception("Error syncing price list %s", source)
+        event["Error"] = str(e)
+    event["Version"] = worker["catalog"]["version"]
+    with worker["lock"]:
+        worker["events"].appendleft(event)
+    return event
+
+# Function to notice catalog changes while a page sits idle: a price list sync or another session's edit
+# reruns the page with the new prices and a toast, so nobody has to reload
+@st.fragment(run_every=PRICE_SYNC_INTERVAL)
+def watch_catalog():
+    catalog = get_shared_catalog()
+    branch_prices = get_branch_prices(st.session_state.branch)
+    if st.session_state.catalog_version == (catalog["version"], branch_prices["version"]):
+        return
+    worker = get_price_sync_worker()
+    with worker["lock"]:
+        events = [event for event in worker["events"] if event["Version"] > st.session_state.catalog_version[0] and not event["Error"]]
+    st.session_state.catalog_notices = [f"Prices updated from {event['Source']}: {event['Updated']} changed, {event['Added']} added" for event in reversed(events)]
+    st.rerun()
+
+# Function to export the catalog in chunks to a temporary file, returned ready for reading
+def export_products(df, file_format):
+    buffer = tempfile.TemporaryFile()
+    if file_format == "xlsx":
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("Products")
+        sheet.append(PRODUCT_COLUMNS)
+        for start in range(0, len(df), EXPORT_CHUNK_SIZE):
+            for values in df.iloc[start:start + EXPORT_CHUNK_SIZE][PRODUCT_COLUMNS].itertuples(index=False):
+                sheet.append([None if not isinstance(value, str) and pd.isna(value) else value for value in values])
+        workbook.save(buffer)
+    else:
+        text = io.TextIOWrapper(buffer, encoding='utf-8-sig' if file_format == "csv" else 'utf-8', newline='')
+        if file_format == "json":
+            text.write("[\n")
+        for start in range(0, len(df), EXPORT_CHUNK_SIZE):
+            chunk = df.iloc[start:start + EXPORT_CHUNK_SIZE][PRODUCT_COLUMNS]
+            if file_format == "csv":
+                chunk.to_csv(text, header=start == 0, index=False)
+            else:
+                records = catalog_records(chunk)
+                lines = ",\n".join(json.dumps(record, ensure_ascii=False) for record in records)
+                text.write((",\n" if start else "") + lines)
+        if file_format == "json":
+            text.write("\n]\n")
+        text.flush()
+        text.detach()
+    buffer.seek(0)
+    return buffer
+
+# Function to start the process-wide invoice renderer: a worker pool plus a cache of rendered documents
+@st.cache_resource
+def get_invoice_renderer():
+    return {
+        "pool": ThreadPoolExecutor(max_workers=INVOICE_WORKERS, thread_name_prefix="invoice"),
+        "cache": OrderedDict(),
+        "lock": threading.Lock(),
+    }
+
+# Function to list the invoice formats that can be rendered here
+def invoice_formats():
+    return ["html"] + (["pdf"] if importlib.util.find_spec("weasyprint") is not None else [])
+
+# Function to reserve count sequential invoice numbers, returns the first one
+def next_invoice_numbers(count=1):
+    if STORAGE_BACKEND == "sqlite":
+        ensure_db()
+        # The insert opens the write transaction, so no other process can take the same numbers
+        with closing(connect_db()) as conn, conn:
+            conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('invoice', 0)")
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'invoice'", (count,))
+            last = conn.execute("SELECT value FROM counters WHERE name = 'invoice'").fetchone()[0]
+        return last - count + 1
+    with get_invoice_renderer()["lock"]:
+        last = 0
+        if os.path.exists(INVOICE_COUNTER_PATH):
+            with open(INVOICE_COUNTER_PATH, 'r', encoding='utf-8') as f:
+                last = json.load(f)["invoice"]
+        write_json_atomic(INVOICE_COUNTER_PATH, {"invoice": last + count})
+    return last + 1
+
+# Function to price cart quantities from the current catalog, one line per product in the cart
+def price_cart_lines(quantities):
+    lines = []
+    for key, qty in quantities.items():
+        if qty > 0:
+            product = get_product(key)
+            if product is not None:
+                unit_price = float(product['Price (EGP)'])
+                lines.append({
+                    "product_id": key,
+                    "part_number": product['Part Number'] if not pd.isna(product['Part Number']) else "",
+                    "product_name": product['Product Name'],
+                    "description": product['Description'] if not pd.isna(product['Description']) else "",
+                    "barcode": catalog_text(product['Barcode']),
+                    "quantity": qty,
+                    "unit_price": unit_price,
+                    "subtotal": round(unit_price * qty, 2),
+                })
+    return lines
+
+# Function to build an invoice from priced lines
+def build_invoice(lines, number, created_at=None):
+    return {
+        "number": f"INV-{number:06d}",
+        "date": datetime.datetime.fromtimestamp(created_at if created_at is not None else time.time()).strftime("%Y-%m-%d %H:%M"),
+        "lines": lines,
+        "total": round(sum(line["subtotal"] for line in lines), 2),
+    }
+
+# Function to fill the invoice template; every catalog value is escaped
+def invoice_html(invoice):
+    lines = "\n".join(
+        INVOICE_LINE_TEMPLATE.substitute(
+            product_name=html.escape(line["product_name"]),
+            description=html.escape(line["description"]),
+            part_number=html.escape(line["part_number"]),
+            barcode=html.escape(line["barcode"]),
+            quantity=line["quantity"],
+            unit_price=f"{line['unit_price']:.2f}",
+            subtotal=f"{line['subtotal']:.2f}",
+        )
+        for line in invoice["lines"]
+    )
+    return INVOICE_TEMPLATE.substitute(number=html.escape(invoice["number"]), date=invoice["date"], lines=lines, total=f"{invoice['total']:.2f}")
+
+# Function run on the invoice pool: render one invoice, reusing the cached document for a reprint. An invoice number
+# printed for a cart that changed before checkout is printed again with other lines, so the cache also checks the HTML
+def render_invoice(renderer, invoice, file_format):
+    cache_key = (invoice["number"], file_format)
+    source = invoice_html(invoice)
+    with renderer["lock"]:
+        if cache_key in renderer["cache"] and renderer["cache"][cache_key][0] == source:
+            renderer["cache"].move_to_end(cache_key)
+            return renderer["cache"][cache_key][1]
+    
+    if file_format == "pdf":
+        # weasyprint shapes and orders Arabic text through Pango
+        import weasyprint
+        document = weasyprint.HTML(string=source).write_pdf()
+    else:
+        document = source.encode('utf-8')
+    
+    with renderer["lock"]:
+        renderer["cache"][cache_key] = (source, document)
+        while len(renderer["cache"]) > INVOICE_CACHE_SIZE:
+            renderer["cache"].popitem(last=False)
+    return document
+
+# Function to take the session's invoice number: the one it took last, while no order has been saved with it, so printing a
+# cart again after it changes, clearing it or a checkout refused for stock leaves no gap in the invoice sequence
+def session_invoice_number():
+    if st.session_state.get('printed_invoice_number') is None:
+        st.session_state.printed_invoice_number = next_invoice_numbers()
+    return st.session_state.printed_invoice_number
+
+# Function to queue the cart's invoice for rendering; printing an unchanged cart again reprints the same invoice
+def print_invoice():
+    cart = {key: qty for key, qty in st.session_state.quantities.items() if qty > 0}
+    job = st.session_state.get('invoice_job')
+    if (job is not None and job["cart"] == cart and job["catalog_version"] == st.session_state.catalog_version
+            and job["invoice_number"] == st.session_state.get('printed_invoice_number')):
+        return
+    
+    invoice_number = session_invoice_number()
+    invoice = build_invoice(price_cart_lines(cart), invoice_number)
+    renderer = get_invoice_renderer()
+    st.session_state.invoice_job = {
+        "cart": cart,
+        "catalog_version": st.session_state.catalog_version,
+        "invoice_number": invoice_number,
+        "invoice": invoice,
+        "futures": {file_format: renderer["pool"].submit(render_invoice, renderer, invoice, file_format) for file_format in invoice_formats()},
+    }
+
+# Function to poll a rendering invoice without rerunning the whole page, then rerun once it is ready
+@st.fragment(run_every=INVOICE_POLL_INTERVAL)
+def render_invoice_progress():
+    job = st.session_state.get('invoice_job')
+    if job is None or all(future.done() for future in job["futures"].values()):
+        st.rerun()
+    st.info(f"Rendering invoice {job['invoice']['number']}...")
+
+# Function to show the invoice download buttons, or the progress while it renders
+def render_invoice_downloads():
+    job = st.session_state.invoice_job
+    if not all(future.done() for future in job["futures"].values()):
+        render_invoice_progress()
+        return
+    
+    number = job["invoice"]["number"]
+    columns = st.columns(len(job["futures"]))
+    for column, (file_format, future) in zip(columns, job["futures"].items()):
+        with column:
+            if future.exception() is not None:
+                st.error(f"Error rendering invoice {number} as {file_format.upper()}: {future.exception()}")
+            else:
+                st.download_button(
+                    f"Download {number} ({file_format.upper()})",
+                    data=future.result(),
+                    file_name=f"{number}.{file_format}",
+                    mime="application/pdf" if file_format == "pdf" else "text/html",
+                    key=f"invoice_{file_format}",
+                )
+
+# Function to get the stock a cart can still take in a branch (on hand minus live reservations of other carts), None if not tracked
+def available_stock(conn, branch, product_id, cart_id):
+    row = conn.execute("SELECT on_hand FROM stock WHERE branch = ? AND product_id = ?", (branch, product_id)).fetchone()
+    if row is None:
+        return None
+    reserved = conn.execute(
+        "SELECT COALESCE(SUM(quantity), 0) FROM reservations WHERE branch = ? AND product_id = ? AND cart_id != ? AND updated_at >= ?",
+        (branch, product_id, cart_id, time.time() - RESERVATION_TTL),
+    ).fetchone()[0]
+    return row[0] - reserved
+
+# Function to set a cart's reservation for a product to quantity, returns (ok, available);
+# with enforce the reservation is refused when it asks for more than is available
+def reserve_stock(branch, cart_id, product_id, quantity, enforce=True):
+    with write_transaction() as conn:
+        available = available_stock(conn, branch, product_id, cart_id)
+        if available is None:
+            return True, None
+        if enforce and quantity > available:
+            return False, available
+        if quantity > 0:
+            conn.execute(
+                "INSERT INTO reservations (cart_id, branch, product_id, quantity, updated_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = excluded.quantity, updated_at = excluded.updated_at",
+                (cart_id, branch, product_id, quantity, time.time()),
+            )
+        else:
+            conn.execute("DELETE FROM reservations WHERE cart_id = ? AND product_id = ?", (cart_id, product_id))
+    return True, available
+
+# Function to drop every reservation held by a cart
+def release_reservations(cart_id):
+    with write_transaction() as conn:
+        conn.execute("DELETE FROM reservations WHERE cart_id = ?", (cart_id,))
+
+# Function to set the stock on hand of a product in a branch; None stops tracking it there
+def set_stock(branch, product_id, on_hand):
+    with write_transaction() as conn:
+        if on_hand is None:
+            conn.execute("DELETE FROM stock WHERE branch = ? AND product_id = ?", (branch, product_id))
+        else:
+            conn.execute(
+                "INSERT INTO stock (branch, product_id, on_hand) VALUES (?, ?, ?)"
+                " ON CONFLICT (branch, product_id) DO UPDATE SET on_hand = excluded.on_hand",
+                (branch, product_id, on_hand),
+            )
+
+# Function to forget the stock, reservations and branch prices of a deleted product in every branch
+def delete_stock(product_id):
+    with write_transaction() as conn:
+        conn.execute("DELETE FROM stock WHERE product_id = ?", (product_id,))
+        conn.execute("DELETE FROM reservations WHERE product_id = ?", (product_id,))
+        if conn.execute("DELETE FROM branch_prices WHERE product_id = ?", (product_id,)).rowcount:
+            bump_revision(conn, "branch_prices_revision", applied_here=False)
+
+# Function to read (on hand, available to this cart) in a branch for a page of products by product ID; untracked products are left out
+def stock_levels(branch, product_ids, cart_id):
+    if not product_ids:
+        return {}
+    ensure_db()
+    with closing(connect_db()) as conn:
+        rows = conn.execute(
+            "SELECT s.product_id, s.on_hand, s.on_hand - COALESCE(SUM(r.quantity), 0) FROM stock s"
+            " LEFT JOIN reservations r ON r.branch = s.branch AND r.product_id = s.product_id AND r.cart_id != ? AND r.updated_at >= ?"
+            f" WHERE s.branch = ? AND s.product_id IN ({', '.join(['?'] * len(product_ids))})"
+            " GROUP BY s.product_id",
+            [cart_id, time.time() - RESERVATION_TTL, branch] + list(product_ids),
+        ).fetchall()
+    return {product_id: (on_hand, available) for product_id, on_hand, available in rows}
+
+# Function to name stock rows (product ID first) after the products in this session's catalog, dropping products it no longer has
+def named_stock_rows(rows):
+    named = []
+    for product_id, *values in rows:
+        product = get_product(product_id)
+        if product is not None:
+            named.append((catalog_text(product['Part Number']), product['Product Name'], *values))
+    return named
+
+# Function to list a branch's stock-tracked products at or below the low-stock threshold, emptiest first
+def low_stock_products(branch):
+    ensure_db()
+    with closing(connect_db()) as conn:
+        rows = conn.execute(
+            "SELECT s.product_id, s.on_hand, s.on_hand - COALESCE(SUM(r.quantity), 0) AS available FROM stock s"
+            " LEFT JOIN reservations r ON r.branch = s.branch AND r.product_id = s.product_id AND r.updated_at >= ?"
+            " WHERE s.branch = ? GROUP BY s.product_id HAVING available <= ?",
+            (time.time() - RESERVATION_TTL, branch, LOW_STOCK_THRESHOLD),
+        ).fetchall()
+    low_stock = pd.DataFrame(named_stock_rows(rows), columns=["Part Number", "Product Name", "On Hand", "Available"])
+    return low_stock.sort_values(["Available", "Part Number"], ignore_index=True)
+
+# Function to find which branches stock the products with a barcode, through the shared barcode index; None when no product has it
+def branches_with_barcode(barcode):
+    barcode = barcode_key(barcode)
+    df = st.session_state.products_df
+    product_ids = [int(df['ID'].iat[position]) for position in st.session_state.search_index["barcode_exact"].get(barcode, ()) if position < len(df)]
+    if not product_ids:
+        return None
+    ensure_db()
+    with closing(connect_db()) as conn:
+        rows = conn.execute(
+            "SELECT s.product_id, b.name, s.on_hand, s.on_hand - COALESCE(SUM(r.quantity), 0) AS available FROM stock s JOIN branches b ON b.id = s.branch"
+            " LEFT JOIN reservations r ON r.branch = s.branch AND r.product_id = s.product_id AND r.updated_at >= ?"
+            f" WHERE s.product_id IN ({', '.join(['?'] * len(product_ids))})"
+            " GROUP BY s.branch, s.product_id ORDER BY available DESC, b.name",
+            [time.time() - RESERVATION_TTL] + product_ids,
+        ).fetchall()
+    branch_stock = pd.DataFrame(named_stock_rows(rows), columns=["Part Number", "Product Name", "Branch", "On Hand", "Available"])
+    return branch_stock[["Branch", "Part Number", "Product Name", "On Hand", "Available"]]
+
+# Function to set a branch's price for a product; None goes back to the master price
+def set_branch_price(branch, product_id, price):
+    catalog = get_shared_catalog()
+    branch_prices = get_branch_prices(branch)
+    with catalog["lock"]:
+        with write_transaction() as conn:
+            if price is None:
+                conn.execute("DELETE FROM branch_prices WHERE branch = ? AND product_id = ?", (branch, product_id))
+            else:
+                conn.execute(
+                    "INSERT INTO branch_prices (branch, product_id, price) VALUES (?, ?, ?)"
+                    " ON CONFLICT (branch, product_id) DO UPDATE SET price = excluded.price",
+                    (branch, product_id, round(float(price), 2)),
+                )
+            bump_revision(conn, "branch_prices_revision")
+        if price is None:
+            branch_prices["prices"].pop(product_id, None)
+        else:
+            branch_prices["prices"][product_id] = round(float(price), 2)
+        branch_prices["version"] += 1
+
+# Function to record orders in the ledger and fold them into the sales aggregates in one transaction, returns the order ids
+def record_orders(orders):
+    with write_transaction() as conn:
+        return write_orders(conn, orders)
+
+# Function to write orders and their aggregate updates on an open transaction, returns the order ids
+def write_orders(conn, orders):
+    daily = defaultdict(lambda: [0, 0, 0.0])
+    product_daily = defaultdict(lambda: [0, 0.0])
+    order_ids = []
+    for order in orders:
+        day = datetime.date.fromtimestamp(order["created_at"]).isoformat()
+        total = round(sum(line["subtotal"] for line in order["lines"]), 2)
+        cursor = conn.execute(
+            "INSERT INTO orders (created_at, cart_id, branch, total, invoice_number) VALUES (?, ?, ?, ?, ?)",
+            (order["created_at"], order.get("cart_id"), order.get("branch"), total, order.get("invoice_number")),
+        )
+        order_ids.append(cursor.lastrowid)
+        conn.executemany(
+            "INSERT INTO order_lines (order_id, part_number, product_name, description, barcode, quantity, unit_price, subtotal) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(cursor.lastrowid, line["part_number"], line["product_name"], line["description"], line["barcode"], line["quantity"], line["unit_price"], line["subtotal"]) for line in order["lines"]],
+        )
+        
+        daily[day][0] += 1
+        for line in order["lines"]:
+            daily[day][1] += line["quantity"]
+            daily[day][2] += line["subtotal"]
+            product_totals = product_daily[(day, line["part_number"], line["product_name"])]
+            product_totals[0] += line["quantity"]
+            product_totals[1] += line["subtotal"]
+    
+    conn.executemany(
+        "INSERT INTO daily_sales (day, orders, units, revenue) VALUES (?, ?, ?, ?)"
+        " ON CONFLICT (day) DO UPDATE SET orders = orders + excluded.orders, units = units + excluded.units, revenue = revenue + excluded.revenue",
+        [(day, *totals) for day, totals in daily.items()],
+    )
+    conn.executemany(
+        "INSERT INTO product_daily_sales (day, part_number, product_name, units, revenue) VALUES (?, ?, ?, ?, ?)"
+        " ON CONFLICT (day, part_number, product_name) DO UPDATE SET units = units + excluded.units, revenue = revenue + excluded.revenue",
+        [(*key, *totals) for key, totals in product_daily.items()],
+    )
+    return order_ids
+
+# Function to check out a cart: take its lines off the stock, drop its reservations and record the order with its
+# invoice number in one transaction; returns (order id, shortages), with no order when any line asks for more than is available
+def checkout_order(branch, cart_id, lines, invoice_number):
+    with write_transaction() as conn:
+        shortages = []
+        for line in lines:
+            available = available_stock(conn, branch, line["product_id"], cart_id)
+            if available is not None and line["quantity"] > available:
+                shortages.append((line["product_name"], max(0, available)))
+        if shortages:
+            return None, shortages
+        
+        conn.executemany(
+            "UPDATE stock SET on_hand = on_hand - ? WHERE branch = ? AND product_id = ?",
+            [(line["quantity"], branch, line["product_id"]) for line in lines],
+        )
+        conn.execute("DELETE FROM reservations WHERE cart_id = ?", (cart_id,))
+        order_id = write_orders(conn, [{"created_at": time.time(), "cart_id": cart_id, "branch": branch, "lines": lines, "invoice_number": invoice_number}])[0]
+    return order_id, []
+
+# Function to check out the session's cart as an order and start an empty cart
+def save_order():
+    cart = {key: qty for key, qty in st.session_state.quantities.items() if qty > 0}
+    lines = price_cart_lines(cart)
+    # The order takes the number of the invoice printed for the cart, so no printed number goes unused
+    try:
+        order_id, shortages = checkout_order(st.session_state.branch, st.session_state.cart_id, lines, session_invoice_number())
+    except Exception as e:
+        st.session_state.order_message = ("error", f"Error saving order: {e}")
+        return
+    if order_id is None:
+        st.session_state.order_message = ("error", "Not enough stock: " + ", ".join(f"{name} ({available} left)" for name, available in shortages))
+        return
+    
+    st.session_state.quantities = defaultdict(int)
+    st.session_state.cart_total = 0.0
+    st.session_state.printed_invoice_number = None
+    flush_cart(st.session_state.cart_id, st.session_state.quantities)
+    st.session_state.order_message = ("success", f"Order #{order_id} saved successfully!")
+    
+    # Warn when the sale took a product down to the low-stock threshold
+    levels = stock_levels(st.session_state.branch, [line["product_id"] for line in lines], st.session_state.cart_id)
+    st.session_state.low_stock_notes = [
+        f"Low stock: {line['product_name']} ({levels[line['product_id']][1]} left)"
+        for line in lines
+        if line["product_id"] in levels and levels[line["product_id"]][1] <= LOW_STOCK_THRESHOLD
+    ]
+
+# Function to load the orders saved on a day with their lines, oldest first
+def orders_on(day):
+    start = datetime.datetime.combine(day, datetime.time()).timestamp()
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()
+    ensure_db()
+    with closing(connect_db()) as conn:
+        orders = {
+            order_id: {"id": order_id, "created_at": created_at, "invoice_number": invoice_number, "lines": []}
+            for order_id, created_at, invoice_number in conn.execute(
+                "SELECT id, created_at, invoice_number FROM orders WHERE created_at >= ? AND created_at < ? ORDER BY id", (start, end)
+            )
+        }
+        rows = conn.execute(
+            "SELECT l.order_id, l.part_number, l.product_name, l.description, l.barcode, l.quantity, l.unit_price, l.subtotal"
+            " FROM orders o JOIN order_lines l ON l.order_id = o.id WHERE o.created_at >= ? AND o.created_at < ? ORDER BY l.rowid",
+            (start, end),
+        )
+        for order_id, part_number, product_name, description, barcode, quantity, unit_price, subtotal in rows:
+            orders[order_id]["lines"].append({
+                "part_number": part_number,
+                "product_name": product_name,
+                "description": description or "",
+                "barcode": barcode or "",
+                "quantity": quantity,
+                "unit_price": unit_price,
+                "subtotal": subtotal,
+            })
+    return list(orders.values())
+
+# Function to read daily revenue, orders and units between two dates (inclusive) from the aggregates
+def daily_sales(start, end):
+    ensure_db()
+    with closing(connect_db()) as conn:
+        return pd.read_sql_query(
+            "SELECT day AS Day, orders AS Orders, units AS Units, revenue AS \"Revenue (EGP)\" FROM daily_sales WHERE day BETWEEN ? AND ? ORDER BY day",
+            conn,
+            params=(start.isoformat(), end.isoformat()),
+        )
+
+# Function to read units and revenue per product between two dates (inclusive), best sellers first
+def product_sales(start, end, rank_by="revenue", limit=None):
+    ensure_db()
+    with closing(connect_db()) as conn:
+        return pd.read_sql_query(
+            "SELECT part_number AS \"Part Number\", product_name AS \"Product Name\", SUM(units) AS Units, ROUND(SUM(revenue), 2) AS \"Revenue (EGP)\""
+            " FROM product_daily_sales WHERE day BETWEEN ? AND ? GROUP BY part_number, product_name"
+            f" ORDER BY {'SUM(units)' if rank_by == 'units' else 'SUM(revenue)'} DESC LIMIT ?",
+            conn,
+            params=(start.isoformat(), end.isoformat(), -1 if limit is None else limit),
+        )
+
+# Function to give orders saved without an invoice number one each, keeping any number another session stored first
+def assign_invoice_numbers(orders):
+    first_number = next_invoice_numbers(len(orders))
+    with write_transaction() as conn:
+        conn.executemany(
+            "UPDATE orders SET invoice_number = ? WHERE id = ? AND invoice_number IS NULL",
+            [(first_number + i, order["id"]) for i, order in enumerate(orders)],
+        )
+        for order in orders:
+            order["invoice_number"] = conn.execute("SELECT invoice_number FROM orders WHERE id = ?", (order["id"],)).fetchone()[0]
+
+# Function to render the invoices of a day's saved orders in parallel, returns (zip bytes, invoice count, seconds).
+# Each order keeps the invoice number it was saved with, so a reprinted invoice comes from the render cache
+def render_invoice_batch(day, file_format):
+    started = time.perf_counter()
+    orders = orders_on(day)
+    if not orders:
+        return None, 0, 0.0
+    
+    unnumbered = [order for order in orders if order["invoice_number"] is None]
+    if unnumbered:
+        assign_invoice_numbers(unnumbered)
+    invoices = [build_invoice(order["lines"], order["invoice_number"], order["created_at"]) for order in orders]
+    renderer = get_invoice_renderer()
+    futures = [renderer["pool"].submit(render_invoice, renderer, invoice, file_format) for invoice in invoices]
+    wait(futures)
+    
+    import zipfile
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for invoice, future in zip(invoices, futures):
+            archive.writestr(f"{invoice['number']}.{file_format}", future.result())
+    return buffer.getvalue(), len(invoices), time.perf_counter() - started
+
+# Function to draw the order summary lines and total into their slot, which the scanner redraws after a scan
+def render_cart_lines(summary_lines):
+    with summary_lines.container():
+        if sum(st.session_state.quantities.values()) > 0:
+            st.markdown("<h2 style='text-align: center; margin-top: 30px;'>Order Summary</h2>", unsafe_allow_html=True)
+        
+            # Create columns for the order summary with headers
+            summary_col1, summary_col2, summary_col3, summary_col4 = st.columns([3, 1, 1, 1])
+            with summary_col1:
+                st.markdown("<strong>Product</strong>", unsafe_allow_html=True)
+            with summary_col2:
+                st.markdown("<strong>Barcode</strong>", unsafe_allow_html=True)
+            with summary_col3:
+                st.markdown("<strong>Quantity</strong>", unsafe_allow_html=True)
+            with summary_col4:
+                st.markdown("<strong>Subtotal</strong>", unsafe_allow_html=True)
+        
+            # Display each order item
+            for key, qty in st.session_state.quantities.items():
+                if qty > 0:
+                    product = get_product(key)
+                
+                    if product is not None:
+                        subtotal = qty * product['Price (EGP)']
+                    
+                        summary_col1, summary_col2, summary_col3, summary_col4 = st.columns([3, 1, 1, 1])
+                        with summary_col1:
+                            st.write(f"{product['Product Name']}")
+                        with summary_col2:
+                            st.write(catalog_text(product['Barcode']))
+                        with summary_col3:
+                            st.write(f"{qty}")
+                        with summary_col4:
+                            st.write(f"{subtotal:.2f} EGP")
+        
+            st.markdown(
+                f"<div style='display: flex; justify-content: space-between; margin-top: 20px; font-size: 22px;'>"
+                f"<span style='font-weight: bold;'>TOTAL:</span>"
+                f"<span style='font-weight: bold; color: #ff9900;'>{st.session_state.cart_total:.2f} EGP</span>"
+                f"</div>", 
+                unsafe_allow_html=True
+            )
+
+# Function to render the order summary, its actions and the invoice downloads; Print Invoice reruns only this part.
+# The lines go into summary_lines, a slot outside this fragment that the scanner fragment can redraw
+@st.fragment
+def render_order_summary(summary_lines):
+    # A checkout empties the cart, so the catalog rows above need redrawing as well
+    if st.session_state.get('order_message') is not None:
+        st.rerun()
+    
+    render_cart_lines(summary_lines)
+    
+    if sum(st.session_state.quantities.values()) > 0:
+        # Order actions
+        col1, col2, col3 = st.columns([1, 1, 1])
+        with col1:
+            # Checkout takes the cart off the stock and records it in the ledger at today's prices
+            st.button("💾 Save Order", key="save_order", on_click=save_order)
+        with col2:
+            st.button("🧾 Print Invoice", key="print_invoice", on_click=print_invoice)
+        with col3:
+            if st.button("🗑️ Clear Cart", key="clear_cart"):
+                st.session_state.quantities = defaultdict(int)
+                st.session_state.cart_total = 0.0
+                st.session_state.invoice_job = None
+                flush_cart(st.session_state.cart_id, st.session_state.quantities)
+                release_reservations(st.session_state.cart_id)
+                st.rerun()  # Updated from experimental_rerun()
+    
+    # The invoice renders in the background; its download buttons appear here when it is ready, and stay after checkout
+    if st.session_state.get('invoice_job') is not None:
+        render_invoice_downloads()
+
+# Function to render the Product Catalog tab: scanner, search, the current page and the order summary.
+# Quantity clicks rerun only this fragment, not the CSS, session setup, other tabs or inventory list;
+# it also owns the header cart total, which it redraws on every run
+@st.fragment
+def render_catalog_view():
+    fragment_started = time.perf_counter()
+    
+    # The scanner shows at the top but is drawn last, once the summary slot it redraws exists
+    scanner_area = st.container()
+    
     # Search functionality
     st.subheader("Search Products")
     col1, col2 = st.columns([3, 1])
@@ -357,23 +3084,28 @@ with tabs[0]:
     with col2:
         search_type = st.radio("Search by:", ["Name/Description", "Barcode", "Part Number"], horizontal=True)
 
-    # Filter products based on search
-    if search_query:
-        if search_type == "Barcode":
-            filtered_df = st.session_state.products_df[st.session_state.products_df['Barcode'].astype(str).str.contains(search_query)]
-        elif search_type == "Part Number":
-            filtered_df = st.session_state.products_df[st.session_state.products_df['Part Number'].astype(str).str.contains(search_query, case=False)]
-        else:
-            filtered_df = st.session_state.products_df[
-                st.session_state.products_df['Product Name'].str.contains(search_query, case=False) | 
-                st.session_state.products_df['Description'].str.contains(search_query, case=False)
-            ]
-    else:
-        filtered_df = st.session_state.products_df
+    # Go back to the first page whenever the search changes
+    if st.session_state.catalog_search != (search_query, search_type):
+        st.session_state.catalog_search = (search_query, search_type)
+        st.session_state.catalog_page = 0
 
     # Display products
     st.markdown("<h2 style='text-align: center;'>Product Catalog</h2>", unsafe_allow_html=True)
 
+    # Only the current page of results is rendered; a search is looked up one page at a time
+    if search_query:
+        requested_page = st.session_state.catalog_page
+        with span("search"):
+            positions, total = search_page(search_query, search_type, requested_page, st.session_state.catalog_page_size)
+        page, page_size = page_controls(total, 'catalog_page', 'catalog_page_size')
+        # The cursor was past the last page of this search
+        if page != requested_page:
+            with span("search"):
+                positions, total = search_page(search_query, search_type, page, page_size)
+        page_df = st.session_state.products_df.iloc[positions]
+    else:
+        page_df = paginate(st.session_state.products_df, 'catalog_page', 'catalog_page_size')
+
     # Create columns for the product listing with styling
     col1, col2, col3 = st.columns([1, 2, 1])
     with col1:
@@ -383,191 +3115,443 @@ with tabs[0]:
     with col3:
         st.markdown("<h3>Quantity</h3>", unsafe_allow_html=True)
 
+    # Stock for the visible page, read in one query
+    with span("stock_levels"):
+        page_stock = stock_levels(st.session_state.branch, page_df['ID'].tolist(), st.session_state.cart_id)
+    
     # Display each product with quantity controls and improved styling
-    for _, row in filtered_df.iterrows():
-        part_number = row['Part Number'] if not pd.isna(row['Part Number']) else ""
-        product_name = row['Product Name']
-        key = f"{part_number}_{product_name}"  # Create a unique key combining part number and product name
+    with span("render_catalog"):
+        for _, row in page_df.iterrows():
+            product_id = int(row['ID'])
+            part_number_html, price_html, country_html, barcode_html, name_html = card_html(row, product_id)
+            current_qty = st.session_state.quantities[product_id]
         
-        barcode = row['Barcode']
-        current_qty = st.session_state.quantities[key]
+            col1, col2, col3 = st.columns([1, 2, 1])
         
-        col1, col2, col3 = st.columns([1, 2, 1])
+            with col1:
+                st.markdown(part_number_html, unsafe_allow_html=True)
+                st.markdown(price_html, unsafe_allow_html=True)
+                st.markdown(country_html, unsafe_allow_html=True)
+                st.markdown(barcode_html, unsafe_allow_html=True)
+                stock = page_stock.get(product_id)
+                if stock is not None:
+                    if stock[1] <= 0:
+                        st.markdown("<div style='color: #ff4d4d; font-weight: bold;'>Out of stock</div>", unsafe_allow_html=True)
+                    elif stock[1] <= LOW_STOCK_THRESHOLD:
+                        st.markdown(f"<div style='color: #ff9900; font-weight: bold;'>Only {stock[1]} left</div>", unsafe_allow_html=True)
+                    else:
+                        st.markdown(f"<div>In stock: {stock[1]}</div>", unsafe_allow_html=True)
         
-        with col1:
-            st.markdown(f"<div><strong>{part_number}</strong></div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='product-price'>Price: {row['Price (EGP)']:.2f} EGP</div>", unsafe_allow_html=True)
-            st.markdown(f"<div>Country: {row['Country']}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='barcode'>Barcode: {barcode}</div>", unsafe_allow_html=True)
-        
-        with col2:
-            st.markdown(f"<div class='product-name'>{product_name}</div>", unsafe_allow_html=True)
-            st.write(row['Description'])
+            with col2:
+                st.markdown(name_html, unsafe_allow_html=True)
+                st.write(row['Description'])
         
-        with col3:
-            col3_1, col3_2, col3_3 = st.columns(3)
-            with col3_1:
-                st.button("➖", key=f"dec_{key}", on_click=update_quantity, args=(part_number, product_name, -1))
-            with col3_2:
-                st.markdown(f"<div class='quantity-display'>{current_qty}</div>", unsafe_allow_html=True)
-            with col3_3:
-                st.button("➕", key=f"inc_{key}", on_click=update_quantity, args=(part_number, product_name, 1))
+            with col3:
+                col3_1, col3_2, col3_3 = st.columns(3)
+                with col3_1:
+                    st.button("➖", key=f"dec_{product_id}", on_click=update_quantity, args=(product_id, -1))
+                with col3_2:
+                    st.markdown(f"<div class='quantity-display'>{current_qty}</div>", unsafe_allow_html=True)
+                with col3_3:
+                    st.button("➕", key=f"inc_{product_id}", on_click=update_quantity, args=(product_id, 1), disabled=stock is not None and current_qty >= stock[1])
         
-        # Add a subtotal for this product if quantity > 0
-        if current_qty > 0:
-            st.markdown(f"<div style='text-align: right; font-weight: bold;'>Subtotal: {current_qty * row['Price (EGP)']:.2f} EGP</div>", unsafe_allow_html=True)
+            # Add a subtotal for this product if quantity > 0
+            if current_qty > 0:
+                st.markdown(f"<div style='text-align: right; font-weight: bold;'>Subtotal: {current_qty * row['Price (EGP)']:.2f} EGP</div>", unsafe_allow_html=True)
         
-        st.markdown("<hr>", unsafe_allow_html=True)
+            st.markdown("<hr>", unsafe_allow_html=True)
+            # Ten elements per row, plus the stock line and the subtotal line when shown
+            count("catalog_rows_rendered")
+            count("elements_rendered", 10 + (stock is not None) + (current_qty > 0))
 
-    # Display order summary with improved styling
-    if sum(st.session_state.quantities.values()) > 0:
-        st.markdown("<h2 style='text-align: center; margin-top: 30px;'>Order Summary</h2>", unsafe_allow_html=True)
-        
-        # Create columns for the order summary with headers
-        summary_col1, summary_col2, summary_col3, summary_col4 = st.columns([3, 1, 1, 1])
-        with summary_col1:
-            st.markdown("<strong>Product</strong>", unsafe_allow_html=True)
-        with summary_col2:
-            st.markdown("<strong>Barcode</strong>", unsafe_allow_html=True)
-        with summary_col3:
-            st.markdown("<strong>Quantity</strong>", unsafe_allow_html=True)
-        with summary_col4:
-            st.markdown("<strong>Subtotal</strong>", unsafe_allow_html=True)
-        
-        # Display each order item
-        for key, qty in st.session_state.quantities.items():
-            if qty > 0:
-                # Split the key back into part_number and product_name
-                part_number, product_name = key.split('_', 1)
-                
-                # Find the product in the DataFrame that matches both part number and product name
-                product_mask = (st.session_state.products_df['Part Number'] == part_number) & \
-                               (st.session_state.products_df['Product Name'] == product_name)
-                
-                if not product_mask.empty and any(product_mask):
-                    product = st.session_state.products_df[product_mask].iloc[0]
-                    subtotal = qty * product['Price (EGP)']
-                    
-                    summary_col1, summary_col2, summary_col3, summary_col4 = st.columns([3, 1, 1, 1])
-                    with summary_col1:
-                        st.write(f"{product['Product Name']}")
-                    with summary_col2:
-                        st.write(f"{product['Barcode']}")
-                    with summary_col3:
-                        st.write(f"{qty}")
-                    with summary_col4:
-                        st.write(f"{subtotal:.2f} EGP")
-        
-        st.markdown(
-            f"<div style='display: flex; justify-content: space-between; margin-top: 20px; font-size: 22px;'>"
-            f"<span style='font-weight: bold;'>TOTAL:</span>"
-            f"<span style='font-weight: bold; color: #ff9900;'>{st.session_state.cart_total:.2f} EGP</span>"
-            f"</div>", 
-            unsafe_allow_html=True
-        )
-        
-        # Order actions
-        col1, col2, col3 = st.columns([1, 1, 1])
-        with col1:
-            if st.button("💾 Save Order", key="save_order"):
-                # Save cart data to file
-                if save_cart(st.session_state.quantities):
-                    st.success("Order saved successfully!")
-        with col2:
-            if st.button("🧾 Print Invoice", key="print_invoice"):
-                st.info("Printing functionality would be implemented here")
-        with col3:
-            if st.button("🗑️ Clear Cart", key="clear_cart"):
-                st.session_state.quantities = defaultdict(int)
-                st.session_state.cart_total = 0.0
-                save_cart(st.session_state.quantities)
-                st.rerun()  # Updated from experimental_rerun()
+    # A quantity click refused for lack of stock
+    if st.session_state.get('stock_message') is not None:
+        st.toast(st.session_state.pop('stock_message'), icon="⚠️")
+    
+    # Result of the last checkout; a successful one leaves an empty cart
+    if st.session_state.get('order_message') is not None:
+        level, message = st.session_state.order_message
+        if level == "error":
+            st.error(message)
+        else:
+            st.success(message)
+        st.session_state.order_message = None
+        for note in st.session_state.pop('low_stock_notes', []):
+            st.toast(note, icon="⚠️")
+    
+    summary_lines = st.empty()
+    render_order_summary(summary_lines)
+    
+    # Barcode scanner fast path
+    with scanner_area:
+        render_scanner(summary_lines)
+    
+    header_total.markdown(f"<h2 style='text-align: center; color: #ff9900;'>Cart Total: {st.session_state.cart_total:.2f} EGP</h2>", unsafe_allow_html=True)
+    
+    # A fragment run ends here rather than at the bottom of the script
+    if METRICS_ENABLED and not script_running:
+        finish_rerun_metrics(fragment_started, scope="catalog")
+
+# App header with styled title
+st.markdown("<h1 style='text-align: center; color: #4CAF50;'>Product Inventory Management</h1>", unsafe_allow_html=True)
+st.markdown(f"<h3 style='text-align: center;'>Branch: {html.escape(st.session_state.branch_name)} · Total Products: {len(st.session_state.products_df)}</h3>", unsafe_allow_html=True)
+
+# Slot for the cart total; the catalog fragment fills it so quantity clicks keep it current
+header_total = st.empty()
+
+# Say why prices changed under an open page
+for notice in st.session_state.pop('catalog_notices', []):
+    st.toast(notice, icon="🔄")
+
+# Create tabs for different sections; only the open tab is run
+tabs = st.tabs(["Product Catalog", "Add New Product", "Manage Inventory", "Sales Analytics"], key="active_tab", on_change="rerun")
+
+# Product Catalog Tab
+with tabs[0]:
+    if tabs[0].open:
+        render_catalog_view()
 
 # Add New Product Tab
 with tabs[1]:
-    st.markdown("<h2 style='text-align: center;'>Add New Product</h2>", unsafe_allow_html=True)
+    if tabs[1].open:
+        st.markdown("<h2 style='text-align: center;'>Add New Product</h2>", unsafe_allow_html=True)
     
-    # Display success message if product was added
-    if 'show_success' in st.session_state and st.session_state.show_success:
-        st.success("Product added successfully!")
-        st.session_state.show_success = False  # Reset after showing
+        # Display success message if product was added
+        if 'show_success' in st.session_state and st.session_state.show_success:
+            st.success("Product added successfully!")
+            st.session_state.show_success = False  # Reset after showing
     
-    # Create form for adding a new product
-    with st.form(key='add_product_form'):
-        col1, col2 = st.columns(2)
+        # Create form for adding a new product
+        with st.form(key='add_product_form'):
+            col1, col2 = st.columns(2)
         
-        with col1:
-            st.text_input("Part Number", key="new_part_number", placeholder="E.g., A12345")
-            st.text_input("Product Name", key="new_product_name", placeholder="E.g., Bosch Power Drill")
-            st.text_area("Description", key="new_description", placeholder="Enter product description here...")
+            with col1:
+                st.text_input("Part Number", key="new_part_number", placeholder="E.g., A12345")
+                st.text_input("Product Name", key="new_product_name", placeholder="E.g., Bosch Power Drill")
+                st.text_area("Description", key="new_description", placeholder="Enter product description here...")
         
-        with col2:
-            st.text_input("Country of Origin", key="new_country", placeholder="E.g., China")
-            st.number_input("Price (EGP)", key="new_price", min_value=0.0, step=0.01, format="%.2f")
-            st.text_input("Barcode", key="new_barcode", placeholder="E.g., 1234567890123")
+            with col2:
+                st.text_input("Country of Origin", key="new_country", placeholder="E.g., China")
+                st.number_input("Price (EGP)", key="new_price", min_value=0.0, step=0.01, format="%.2f")
+                st.text_input("Barcode", key="new_barcode", placeholder="E.g., 1234567890123")
+                st.number_input("Opening Stock", key="new_stock", min_value=0, step=1, placeholder="Leave empty to not track stock")
         
-        # Submit button
-        submit_button = st.form_submit_button(label="Add Product", on_click=add_new_product)
+            # Submit button
+            submit_button = st.form_submit_button(label="Add Product", on_click=add_new_product)
+    
+        # Bulk import from a supplier price list
+        st.markdown("<h3 style='text-align: center; margin-top: 30px;'>Bulk Import</h3>", unsafe_allow_html=True)
+        st.write("Columns: " + ", ".join(PRODUCT_COLUMNS) + ". Rows update the product with the same barcode, or else the same part number, in the columns the file has;"
+                 " other rows are added and need at least Product Name and Price.")
+        import_file = st.file_uploader("Price list", type=["csv", "xlsx", "json", "jsonl"], key="import_file")
+        if import_file is not None and st.button("Import Products", key="import_products"):
+            try:
+                inserted, updated, rejects = import_products(import_file)
+                st.success(f"Added {inserted} and updated {updated} products")
+                if rejects:
+                    st.warning(f"{len(rejects)} rows were rejected")
+                    st.dataframe(pd.DataFrame(rejects), hide_index=True)
+            except Exception as e:
+                st.error(f"Error importing products: {e}")
+    
+        # Background sync of supplier price lists
+        st.markdown("<h3 style='text-align: center; margin-top: 30px;'>Price List Sync</h3>", unsafe_allow_html=True)
+        st.write(
+            f"Price lists ({', '.join(PRICE_LIST_SUFFIXES)}) dropped into the {os.path.abspath(PRICE_DROP_DIR)} folder"
+            + (f" or served at {PRICE_SYNC_URL}" if PRICE_SYNC_URL else "")
+            + " are applied automatically; only rows that change are written."
+        )
+        if not PRICE_SYNC_ENABLED:
+            st.info("Another worker process syncs the price lists; changes it makes show up here within seconds.")
+        price_sync_worker = get_price_sync_worker()
+        with price_sync_worker["lock"]:
+            sync_events = list(price_sync_worker["events"])
+        if sync_events:
+            st.dataframe(pd.DataFrame(sync_events).drop(columns=["Version"]), hide_index=True)
 
 # Manage Inventory Tab
 with tabs[2]:
-    st.markdown("<h2 style='text-align: center;'>Manage Inventory</h2>", unsafe_allow_html=True)
+    if tabs[2].open:
+        st.markdown("<h2 style='text-align: center;'>Manage Inventory</h2>", unsafe_allow_html=True)
     
-    # Display success message if product was deleted
-    if st.session_state.delete_success:
-        st.success("Product deleted successfully!")
-        st.session_state.delete_success = False  # Reset after showing
+        # Display success message if product was deleted
+        if st.session_state.delete_success:
+            st.success("Product deleted successfully!")
+            st.session_state.delete_success = False  # Reset after showing
     
-    # Display all products with delete buttons
-    for index, row in st.session_state.products_df.iterrows():
-        part_number = row['Part Number'] if not pd.isna(row['Part Number']) else ""
-        product_name = row['Product Name']
-        key = f"{part_number}_{product_name}"
+        # Display the current page of products with delete buttons and their stock on hand
+        inventory_df = paginate(st.session_state.products_df, 'inventory_page', 'inventory_page_size')
+        branch_prices = get_branch_prices(st.session_state.branch)["prices"]
+        inventory_stock = stock_levels(st.session_state.branch, inventory_df['ID'].tolist(), st.session_state.cart_id)
+        for index, row in inventory_df.iterrows():
+            part_number = row['Part Number'] if not pd.isna(row['Part Number']) else ""
+            product_name = row['Product Name']
+            product_id = int(row['ID'])
+            stock = inventory_stock.get(product_id)
+            # The stock on hand is part of the widget key, so a change made elsewhere shows up instead of the last value typed here
+            stock_key = f"stock_{product_id}_{stock[0] if stock is not None else ''}"
+            branch_price = branch_prices.get(product_id)
+            branch_price_key = f"branch_price_{product_id}_{branch_price if branch_price is not None else ''}"
         
-        col1, col2, col3 = st.columns([3, 1, 1])
+            col1, col2, col3 = st.columns([3, 1, 1])
         
-        with col1:
-            st.markdown(f"<div class='product-name'>{product_name}</div>", unsafe_allow_html=True)
-            st.write(f"Part Number: {part_number}")
-            st.write(f"Price: {row['Price (EGP)']:.2f} EGP")
+            with col1:
+                st.markdown(f"<div class='product-name'>{product_name}</div>", unsafe_allow_html=True)
+                st.write(f"Part Number: {part_number}")
+                st.write(f"Price: {row['Price (EGP)']:.2f} EGP")
         
-        with col2:
-            st.markdown(f"<div class='barcode'>Barcode: {row['Barcode']}</div>", unsafe_allow_html=True)
-            st.write(f"Country: {row['Country']}")
+            with col2:
+                st.markdown(f"<div class='barcode'>Barcode: {catalog_text(row['Barcode'])}</div>", unsafe_allow_html=True)
+                st.write(f"Country: {row['Country']}")
+                st.number_input(
+                    "Stock on hand",
+                    value=stock[0] if stock is not None else None,
+                    min_value=0,
+                    step=1,
+                    placeholder="Not tracked",
+                    key=stock_key,
+                    on_change=update_stock,
+                    args=(product_id, stock_key),
+                )
+                st.number_input(
+                    "Branch price (EGP)",
+                    value=branch_price,
+                    min_value=0.01,
+                    step=0.01,
+                    format="%.2f",
+                    placeholder="Master price",
+                    key=branch_price_key,
+                    on_change=update_branch_price,
+                    args=(product_id, branch_price_key),
+                )
         
-        with col3:
-            st.markdown("<div class='delete-button'>", unsafe_allow_html=True)
-            st.button("🗑️ Delete", key=f"del_{key}", on_click=show_delete_confirmation, args=(key,))
-            st.markdown("</div>", unsafe_allow_html=True)
+            with col3:
+                st.markdown("<div class='delete-button'>", unsafe_allow_html=True)
+                st.button("🗑️ Delete", key=f"del_{product_id}", on_click=show_delete_confirmation, args=(product_id,))
+                st.markdown("</div>", unsafe_allow_html=True)
         
-        st.markdown("<hr>", unsafe_allow_html=True)
+            st.markdown("<hr>", unsafe_allow_html=True)
     
-    # Data backup and restore options
-    st.markdown("<h3 style='text-align: center; margin-top: 30px;'>Data Management</h3>", unsafe_allow_html=True)
+        # Low-stock alerts over every product this branch tracks
+        low_stock = low_stock_products(st.session_state.branch)
+        if not low_stock.empty:
+            st.markdown("<h3 style='text-align: center; margin-top: 30px;'>Low Stock Alerts</h3>", unsafe_allow_html=True)
+            st.warning(f"{len(low_stock)} products have {LOW_STOCK_THRESHOLD} or fewer units available")
+            st.dataframe(low_stock, hide_index=True)
     
-    col1, col2 = st.columns(2)
+        # Bulk repricing of the master catalog: preview the changed prices, then write them in one batch
+        st.markdown("<h3 style='text-align: center; margin-top: 30px;'>Bulk Repricing</h3>", unsafe_allow_html=True)
+        catalog = get_shared_catalog()
+        col1, col2 = st.columns(2)
+        with col1:
+            reprice_countries = st.multiselect("Countries", sorted(st.session_state.products_df['Country'].cat.categories), key="reprice_countries", placeholder="All countries")
+        with col2:
+            reprice_prefix = st.text_input("Part number prefix", key="reprice_prefix", placeholder="All part numbers")
+        reprice_operation = st.radio("Change prices by", ["Percentage", "Exchange rate"], horizontal=True, key="reprice_operation")
+        if reprice_operation == "Percentage":
+            reprice_percent = st.number_input("Change (%)", min_value=-99.0, value=0.0, step=0.5, key="reprice_percent")
+            reprice_factor = 1 + reprice_percent / 100
+        else:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                reprice_currency = st.text_input("Supplier currency", value="USD", key="reprice_currency")
+            with col2:
+                old_rate = st.number_input(f"Old rate (EGP per {reprice_currency})", min_value=0.0001, value=1.0, format="%.4f", key="reprice_old_rate")
+            with col3:
+                new_rate = st.number_input(f"New rate (EGP per {reprice_currency})", min_value=0.0001, value=1.0, format="%.4f", key="reprice_new_rate")
+            reprice_factor = new_rate / old_rate
+        reprice_rounding = st.selectbox("Rounding", PRICE_ROUNDING_RULES, key="reprice_rounding")
+        if st.button("Preview Repricing", key="reprice_preview_button"):
+            with catalog["lock"]:
+                reprice_df, reprice_version = catalog["df"], catalog["version"]
+            positions, new_prices = reprice_catalog(reprice_df, reprice_countries, reprice_prefix.strip(), reprice_factor, reprice_rounding)
+            st.session_state.reprice_plan = {
+                "version": reprice_version,
+                "positions": positions,
+                "prices": new_prices,
+                "preview": reprice_preview(reprice_df, positions, new_prices),
+            }
+        reprice_plan = st.session_state.get('reprice_plan')
+        if reprice_plan is not None:
+            changed_count = len(reprice_plan["positions"])
+            if changed_count == 0:
+                st.info("No prices would change")
+            else:
+                st.write(f"{changed_count} master prices will change" + (f" (showing the first {REPRICE_PREVIEW_ROWS})" if changed_count > REPRICE_PREVIEW_ROWS else ""))
+                st.dataframe(reprice_plan["preview"], hide_index=True)
+                col1, col2 = st.columns(2)
+                with col1:
+                    if st.button("Apply Repricing", key="reprice_apply"):
+                        try:
+                            if apply_repricing(catalog, reprice_plan["version"], reprice_plan["positions"], reprice_plan["prices"]):
+                                del st.session_state.reprice_plan
+                                sync_catalog()
+                                calculate_cart_total()
+                                st.success(f"{changed_count} prices updated")
+                            else:
+                                del st.session_state.reprice_plan
+                                st.error("The catalog changed since this preview; preview the repricing again")
+                        except Exception as e:
+                            st.error(f"Error applying repricing: {e}")
+                with col2:
+                    if st.button("Discard Preview", key="reprice_discard"):
+                        del st.session_state.reprice_plan
+                        st.rerun()
     
-    with col1:
-        if st.button("Backup Data", key="backup_data"):
-            try:
-                import datetime
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                backup_file = f"inventory_backup_{timestamp}.json"
-                
-                with open(backup_file, 'w', encoding='utf-8') as f:
-                    json.dump(st.session_state.products_df.to_dict('records'), f, ensure_ascii=False, indent=4)
-                
-                st.success(f"Data backed up to {backup_file}")
-            except Exception as e:
-                st.error(f"Error creating backup: {e}")
+        # Branches: stock across the chain and adding new branches
+        st.markdown("<h3 style='text-align: center; margin-top: 30px;'>Branches</h3>", unsafe_allow_html=True)
+        st.write(f"This session works for {st.session_state.branch_name} ({st.session_state.branch}). Open another branch with ?branch=<id> in the URL.")
+        lookup_barcode = st.text_input("Find a barcode in every branch", key="branch_lookup")
+        if lookup_barcode.strip():
+            branch_stock = branches_with_barcode(lookup_barcode)
+            if branch_stock is None:
+                st.info("No product has this barcode")
+            elif branch_stock.empty:
+                st.info("No branch tracks stock for this product")
+            else:
+                st.dataframe(branch_stock, hide_index=True)
+        with st.form("add_branch_form", clear_on_submit=True):
+            col1, col2 = st.columns(2)
+            with col1:
+                new_branch = st.text_input("Branch ID", placeholder="e.g. alexandria")
+            with col2:
+                new_branch_name = st.text_input("Branch name")
+            if st.form_submit_button("Add Branch"):
+                error = add_branch(new_branch.strip(), new_branch_name)
+                if error:
+                    st.error(error)
+                else:
+                    st.success(f"Branch added; open it with ?branch={new_branch.strip()}")
     
-    with col2:
-        # This is a placeholder. In a real application, you would need a way to select and upload files
-        if st.button("Restore Default Data", key="restore_defaults"):
-            if st.session_state.products_df is not None:
-                st.session_state.products_df = create_default_data()
-                st.success("Default data restored!")
-                st.rerun()  # Updated from experimental_rerun()
+        # Data backup and restore options
+        st.markdown("<h3 style='text-align: center; margin-top: 30px;'>Data Management</h3>", unsafe_allow_html=True)
+    
+        col1, col2 = st.columns(2)
+    
+        with col1:
+            if st.button("Backup Data", key="backup_data"):
+                try:
+                    catalog = get_shared_catalog()
+                    with catalog["lock"]:
+                        backup_file = take_snapshot(catalog)
+                    if backup_file is None:
+                        st.warning("The catalog is catching up with another worker's changes; try again in a moment.")
+                    else:
+                        st.success(f"Data backed up to {backup_file}")
+                except Exception as e:
+                    st.error(f"Error creating backup: {e}")
+    
+        with col2:
+            # This is a placeholder. In a real application, you would need a way to select and upload files
+            if st.button("Restore Default Data", key="restore_defaults"):
+                if st.session_state.products_df is not None:
+                    catalog = get_shared_catalog()
+                    with catalog["lock"]:
+                        replace_catalog(catalog, create_default_data(catalog["df"]))
+                        log_change(catalog, {"op": "replace", "products": catalog_records(catalog["df"])})
+                    sync_catalog()
+                    calculate_cart_total()
+                    st.success("Default data restored!")
+                    st.rerun()  # Updated from experimental_rerun()
+    
+        # Point-in-time restore from the change history
+        restore_from = oldest_restore_point()
+        if restore_from is not None:
+            st.markdown("<h4 style='margin-top: 20px;'>Restore to a Point in Time</h4>", unsafe_allow_html=True)
+            st.write(f"History goes back to {datetime.datetime.fromtimestamp(restore_from):%Y-%m-%d %H:%M:%S}.")
+            col1, col2, col3 = st.columns([1, 1, 1])
+            with col1:
+                restore_date = st.date_input("Date", key="restore_date")
+            with col2:
+                restore_time = st.time_input("Time", key="restore_time", step=60)
+            with col3:
+                if st.button("Restore", key="restore_point"):
+                    restore_timestamp = datetime.datetime.combine(restore_date, restore_time).timestamp()
+                    if restore_catalog(restore_timestamp):
+                        st.success("Catalog restored!")
+                        st.rerun()
+                    else:
+                        st.error("No history is available for that time")
+    
+        # Render the invoices for every cart saved on a day
+        st.markdown("<h4 style='margin-top: 20px;'>Batch Invoices</h4>", unsafe_allow_html=True)
+        col1, col2, col3 = st.columns([1, 1, 1])
+        with col1:
+            batch_day = st.date_input("Orders saved on", key="batch_invoice_day")
+        with col2:
+            batch_format = st.selectbox("Format", invoice_formats(), key="batch_invoice_format")
+        with col3:
+            if st.button("Render Invoices", key="batch_invoices"):
+                with st.spinner("Rendering invoices..."):
+                    st.session_state.invoice_batch = (batch_day, batch_format) + render_invoice_batch(batch_day, batch_format)
+        if st.session_state.get('invoice_batch') is not None:
+            batch_day, batch_format, archive, invoice_count, elapsed = st.session_state.invoice_batch
+            if invoice_count == 0:
+                st.info(f"No saved orders on {batch_day}")
+            else:
+                st.success(f"Rendered {invoice_count} invoices in {elapsed:.2f} s ({invoice_count / elapsed:.1f} invoices/s)")
+                st.download_button(f"Download invoices for {batch_day}", data=archive, file_name=f"invoices_{batch_day}_{batch_format}.zip", mime="application/zip", key="batch_invoices_download")
+    
+        # Export the catalog; files are only generated when a button is clicked
+        export_formats = ["csv", "json"] + (["xlsx"] if importlib.util.find_spec("openpyxl") is not None else [])
+        export_columns = st.columns(len(export_formats))
+        for export_column, file_format in zip(export_columns, export_formats):
+            with export_column:
+                st.download_button(
+                    f"Export {file_format.upper()}",
+                    data=lambda file_format=file_format, df=st.session_state.products_df: export_products(df, file_format),
+                    file_name=f"inventory_export.{file_format}",
+                    key=f"export_{file_format}",
+                )
+
+# Sales Analytics Tab - every figure comes from the daily aggregates, never from the raw order lines
+with tabs[3]:
+    if tabs[3].open:
+        st.markdown("<h2 style='text-align: center;'>Sales Analytics</h2>", unsafe_allow_html=True)
+    
+        col1, col2 = st.columns(2)
+        with col1:
+            analytics_from = st.date_input("From", value=datetime.date.today() - datetime.timedelta(days=29), key="analytics_from")
+        with col2:
+            analytics_to = st.date_input("To", value=datetime.date.today(), key="analytics_to")
+    
+        with span("analytics"):
+            sales = daily_sales(analytics_from, analytics_to)
+        if sales.empty:
+            st.info("No orders in this period")
+        else:
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("Revenue", f"{sales['Revenue (EGP)'].sum():,.2f} EGP")
+            col2.metric("Orders", f"{sales['Orders'].sum():,}")
+            col3.metric("Units Sold", f"{sales['Units'].sum():,}")
+            col4.metric("Average Order", f"{sales['Revenue (EGP)'].sum() / sales['Orders'].sum():,.2f} EGP")
+        
+            st.subheader("Daily Revenue")
+            st.line_chart(sales.set_index("Day")["Revenue (EGP)"])
+        
+            st.subheader("Top Products")
+            col1, col2 = st.columns(2)
+            with col1:
+                top_n = st.selectbox("Show", [5, 10, 25, 50], index=1, key="analytics_top_n")
+            with col2:
+                rank_by = st.radio("Rank by", ["Revenue", "Units"], horizontal=True, key="analytics_rank_by")
+            with span("analytics"):
+                top_products = product_sales(analytics_from, analytics_to, rank_by.lower(), top_n)
+            st.dataframe(top_products, hide_index=True)
+        
+            st.subheader("Units per Part Number")
+            with span("analytics"):
+                units = product_sales(analytics_from, analytics_to, "units")
+            st.dataframe(units, hide_index=True)
+
+# Without the catalog tab open nothing else draws the cart total
+if not tabs[0].open:
+    header_total.markdown(f"<h2 style='text-align: center; color: #ff9900;'>Cart Total: {st.session_state.cart_total:.2f} EGP</h2>", unsafe_allow_html=True)
+
+# Start the background price-list sync for this server process and watch for catalog changes
+get_price_sync_worker()
+get_shared_state_watcher()
+watch_catalog()
 
 # Delete confirmation dialog - Using Streamlit containers for better display
 if st.session_state.show_delete_confirm:
@@ -591,3 +3575,19 @@ if st.session_state.show_delete_confirm:
             if st.button("Delete", key="confirm_delete"):
                 delete_product()
                 st.rerun()  # Updated from experimental_rerun()
+
+# Close this rerun's metrics; reruns cut short by st.rerun() carry their spans over to the next one
+if METRICS_ENABLED:
+    if profiler is not None:
+        import pstats
+        profiler.disable()
+        st.session_state.pop('profiler', None)
+        profile_output = io.StringIO()
+        pstats.Stats(profiler, stream=profile_output).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        st.session_state.last_profile = profile_output.getvalue()
+    finish_rerun_metrics(rerun_started)
+script_running = False
+
+# Instrumentation panel for admins
+if is_admin():
+    render_metrics_panel()
@@ -0,0 +1,155 @@
+"""Run deploy.py as several worker processes behind a local load balancer.
+
+Each worker is its own `streamlit run` process, so sessions spread over CPU
+cores instead of sharing one interpreter. The workers share the catalog,
+stock, orders and carts through the SQLite database and the files in the
+working directory, and pick up each other's catalog and branch price changes
+within SHARED_STATE_POLL_INTERVAL. Only the first worker syncs price lists.
+
+The balancer pins every client address to one worker: a session's file
+uploads and downloads are served by the process that runs the session.
+
+    python serve.py --workers 4 --port 8501
+    python serve.py --workers 4 -- --server.enableXsrfProtection false
+"""
+import argparse
+import asyncio
+import os
+import secrets
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "deploy.py")
+PIPE_CHUNK_SIZE = 64 * 1024
+
+
+# Function to find a free local port for a worker
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+# Function to start one worker process on a local port
+def start_worker(index, port, cookie_secret, streamlit_args):
+    # One cookie secret for all workers, so a cookie signed by one is valid on the others
+    env = {**os.environ, "STREAMLIT_SERVER_COOKIE_SECRET": cookie_secret}
+    if index > 0:
+        env["INVENTORY_PRICE_SYNC"] = "0"
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "streamlit", "run", APP_PATH,
+            "--server.headless", "true", "--server.port", str(port), "--server.address", "127.0.0.1",
+            "--browser.gatherUsageStats", "false",
+            *streamlit_args,
+        ],
+        env=env,
+    )
+
+
+# Function to wait until a worker answers its health check
+def wait_until_healthy(process, port, timeout=60):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return
+        except OSError:
+            if time.time() > deadline or process.poll() is not None:
+                raise RuntimeError(f"worker on port {port} did not start")
+            time.sleep(0.2)
+
+
+# Function to copy bytes from one side of a proxied connection to the other until it closes
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(PIPE_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+# Function to serve the balancer: each new client address goes to the worker with the fewest addresses pinned to it
+async def balance(host, port, worker_ports):
+    pins = {}
+    pinned = [0] * len(worker_ports)
+
+    async def handle(client_reader, client_writer):
+        address = client_writer.get_extra_info("peername")[0]
+        worker = pins.get(address)
+        if worker is None:
+            worker = min(range(len(worker_ports)), key=pinned.__getitem__)
+            pins[address] = worker
+            pinned[worker] += 1
+        try:
+            worker_reader, worker_writer = await asyncio.open_connection("127.0.0.1", worker_ports[worker])
+        except OSError:
+            client_writer.close()
+            return
+        await asyncio.gather(pipe(client_reader, worker_writer), pipe(worker_reader, client_writer))
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+# Function to restart any worker that exits, on the same port
+async def supervise(workers, worker_ports, cookie_secret, streamlit_args):
+    while True:
+        await asyncio.sleep(1)
+        for index, process in enumerate(workers):
+            if process.poll() is not None:
+                print(f"worker {index} exited with code {process.returncode}, restarting", file=sys.stderr)
+                workers[index] = start_worker(index, worker_ports[index], cookie_secret, streamlit_args)
+
+
+# Function to run the balancer and the worker supervisor together
+async def serve(host, port, workers, worker_ports, cookie_secret, streamlit_args):
+    await asyncio.gather(balance(host, port, worker_ports), supervise(workers, worker_ports, cookie_secret, streamlit_args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8501)
+    parser.add_argument("streamlit_args", nargs="*", help="extra `streamlit run` options for every worker, after --")
+    args = parser.parse_args()
+
+    # The JSON backend rewrites whole files, so workers would overwrite each other's catalog changes
+    if os.environ.get("INVENTORY_STORAGE", "sqlite") != "sqlite":
+        parser.error("several workers need the SQLite storage backend")
+
+    cookie_secret = secrets.token_hex(32)
+    worker_ports = [free_port() for _ in range(args.workers)]
+    workers = []
+    # SIGTERM stops the balancer like Ctrl+C, so the workers are stopped with it
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for index, worker_port in enumerate(worker_ports):
+            workers.append(start_worker(index, worker_port, cookie_secret, args.streamlit_args))
+        for process, worker_port in zip(workers, worker_ports):
+            wait_until_healthy(process, worker_port)
+        print(f"{args.workers} workers serving http://{args.host}:{args.port}", flush=True)
+        asyncio.run(serve(args.host, args.port, workers, worker_ports, cookie_secret, args.streamlit_args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()